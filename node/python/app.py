@@ -1,354 +1,354 @@
-import jsonpickle
-import random
-import os
-from flask_cors import CORS
-from flask import Flask, request
-from utils import *
-import requests
-from datetime import datetime
-import argparse
+import json
+import socket
 import threading
+import time
+from http import HTTPStatus
 
-import socket
-socket.setdefaulttimeout(5)
+from utils import *
+from protocol import *
 
-PRINT_TO_STD = True
-if not PRINT_TO_STD:
-    open('output', 'w+', encoding='utf-8').close()
+# Importing this module has no side effects - Flask, requests and jsonpickle are only loaded once a node starts
+# sending or serving. create_node() builds a node, start() starts its timers and serve() blocks in the HTTP server
 
+PRINT_TO_STD = True
 MODE = 'ip'
 TIMEOUT_SEC = 30
+SEND_TIMEOUT_SEC = 0.5
 
-# port runs on localhost, ip runs on network
-# port expects ports 5001, 5002, ...
-# ip expects addresses 10.0.1.101, 102, ...
-if MODE == 'port':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--port', required=True, type=int)
-    parser.add_argument('--n_nodes', required=True, type=int)
-    args = vars(parser.parse_args())
-    PORT = args['port']
-    IP_ADDRESS = 'localhost'
-    NODE_COUNT = args['n_nodes']
-elif MODE == 'ip':
-    IP_ADDRESS = os.environ['IP_ADDRESS']
-    NODE_COUNT = os.environ['NUM_NODES']
-    PORT = 5000
-
-
-network_info = NetworkInfo(random.randint(0, 2_000_000_000), IP_ADDRESS, NODE_COUNT, PORT, MODE)
-timer_manager = TimerManager(TIMEOUT_SEC)
-counters = {}
-
-
-def send_leader_down_message():
-    if network_info.leader_id != -1:
-        return
-    log_message(f'Sending LEADER_DOWN to the right neighbour')
-    send_message_async(BaseRequest(network_info.id, MessageType.LEADER_DOWN))
-
-    # continue the timer, we can cancel it later
-    timer_manager.add_timer_and_run('leader_down', send_leader_down_message)
-
-
-def send_election_message():
-    try:
-        # timeout when initializing the network - 10 minutes
-        if counters['election_init'] * TIMEOUT_SEC >= 720:
-            log_message('Could not contact the right neighbour for 10 minutes, assuming dead and moving onto next one')
-            network_info.next_neighbour_shift()
-            log_message(f'New right neighbour: {network_info.get_right_neighbour_address()}')
-
-        log_message(f'Sending ELECTION to the right neighbour')
-        response = send_message(BaseRequest(network_info.id, MessageType.ELECTION_ROUND))
-        network_info.right_neighbour_id = response.json()['id']
-        log_message(f'OK sending ELECTION to the right neighbour')
-
-        # Now that we know our right neighbour is alive, we can start pinging him
-        exists = timer_manager.add_run_if_not_existing('ping', ping_right_neighbour)
-        if exists:
-            log_message('-- starting ping in send_election_message')
-        counters['election_init'] = 0
-
-        # if we have not received the LEADER ELECTED message, we don't know if the ring is complete
-        # so we continue sending the message
-        if not network_info.round_trip_made:
-            timer_manager.add_timer_and_run('election_init', send_election_message, True)
-            log_message('-- round trip not made yet, continue sending ELECTION messages')
-
-    except Exception:
-        log_message(f'FAIL sending ELECTION to the right neighbour')
-        timer_manager.add_timer_and_run('election_init', send_election_message, True)
-        log_message('-- continue sending ELECTION messages')
-        counters['election_init'] += 1
-
-
-def recover_neighbour_dead():
-    leader_dead = network_info.right_neighbour_id == network_info.leader_id
-    neighbour_reachable = False
-    while not neighbour_reachable:
-        valid = network_info.next_neighbour_shift()
-        if not valid:
-            log_message('Only one node left in the ring, setting as leader and coloring GREEN')
-            network_info.leader_id = network_info.id
-            network_info.color = Color.GREEN
-            return
 
-        # try to contact the next in ring
-        log_message(f'Setting right neighbour to {network_info.get_right_neighbour_address()}, contacting')
+class Node:
+    """
+    Node running on Flask and threads
+    """
+    def __init__(self, config):
+        node_id = create_node_id(config)
+        self.config = config
+        self.network_info = NetworkInfo(node_id, config.ip, config.node_count, config.port, config.mode,
+                                        config.members)
+        self.network_info.tracer = Tracer(config.trace_sample)
+        self.network_info.coloring = create_coloring(config)
+        self.network_info.election = config.election
+        self.logger = RingLogger(node_id, None if PRINT_TO_STD else 'output', LOG_LEVELS[config.log_level],
+                                 config.log_sample, json_lines=config.log_format == 'json')
+        self.timer_manager = TimerManager(config.timeout_sec)
+        self.connection_pool = ConnectionPool()
+        self.outbound_queue = OutboundQueue(self.send_message, on_failure=self.send_failed, batch=self.batch_messages)
+        # the protocol changes the node state from the request threads and the timer jobs at the same time, it runs
+        # under this lock - the jobs let go of it while waiting for a reply
+        self.state_lock = threading.Lock()
+        # the reply to PING and most other messages never changes, so it is encoded only once
+        self.plain_reply = json.dumps(reply_body(self.network_info)).encode('utf-8')
+
+    def start(self):
+        self.outbound_queue.start()
+
+        self.log_message(f'Node {self.network_info.id} starting up')
+        self.log_message(f'Node IP: {self.network_info.ip}:{self.network_info.port}\n'
+                         f'Neighbour IP: {self.network_info.get_right_neighbour_address()}\n'
+                         f'Number of nodes: {self.network_info.node_count}')
+
+        self.timer_manager.add_timer_and_run('election_init', self.timer_callback('election_init'))
+        self.log_message('-- starting ELECTION timer')
+        # if the ring is already running, we only get spliced into it
+        self.timer_manager.add_timer_and_run('join', self.timer_callback('join'), timeout=JOIN_DELAY_SEC)
+
+    def serve(self):
+        """
+        Serves the node with the configured HTTP server, blocks. All the request threads share this node - with more
+        processes each would be a node of its own
+        """
+        # if ip, listen on all interfaces
+        host = self.network_info.ip if self.network_info.mode == 'port' else '0.0.0.0'
+        app = create_wsgi_app(self, create_app(self))
+        if self.config.server == 'waitress':
+            self.serve_waitress(app, host)
+        else:
+            self.serve_werkzeug(app, host)
+
+    def serve_werkzeug(self, app, host):
+        import logging
+        from werkzeug.serving import WSGIRequestHandler, run_simple
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        # the default HTTP/1.0 closes the connection after every reply, which defeats the connection pooling
+        WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+        # the headers and body are written separately, with Nagle's algorithm on the reply would wait for the
+        # delayed ACK
+        WSGIRequestHandler.disable_nagle_algorithm = True
+        # keep the idle connections open longer than between two pings, otherwise the ping can race with the server
+        # closing the connection it reuses
+        WSGIRequestHandler.timeout = 3 * PROBE_INTERVAL_SEC
+
+        run_simple(host, self.network_info.port, app, threaded=True)
+
+    def serve_waitress(self, app, host):
+        import logging
+        from waitress import serve
+
+        # all the threads busy is reported on every request under load
+        logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+        self.log_message(f'Serving with waitress, {self.config.threads} threads')
+        # keeps the HTTP/1.1 connections open, the idle ones for longer than between two pings as above
+        serve(app, host=host, port=self.network_info.port, threads=self.config.threads,
+              channel_timeout=3 * PROBE_INTERVAL_SEC, ident=None, _quiet=True)
+
+    def process_message(self, data, content_type):
+        """
+        Handles a message received over HTTP
+        :return: (reply body, status)
+        """
+        started = time.monotonic()
         try:
-            response = send_message(BaseRequest(network_info.id, MessageType.PING))
-            network_info.right_neighbour_id = response.json()['id']
-            neighbour_reachable = True
-            timer_manager.add_timer_and_run('ping', ping_right_neighbour)
-            log_message('-- starting pinging after neighbour reached')
-        except Exception:
-            log_message(f'Could not contact {network_info.right_neighbour_ip}')
-
-    if leader_dead:
-
-        network_info.leader_id = -1
-        # if the leader is down, we send a message to inform others that the leader is down - this message
-        # should be able to make it's way around the ring setting everyone's leader IDs to -1, allowing for the election
-        # process to take place
-        timer_manager.add_timer_and_run('leader_down', send_leader_down_message)
-        log_message('-- started leader down timer')
-    else:
-        # if the node is not the leader, we just send a message announcing it around and the leader catches it
-        # he will then collect IDs again and color the ring
-        if network_info.leader_id == network_info.id:
-            # If we are the leader, we just send it to ourselves
-            log_message('Sending NODE_DOWN message to SELF')
-            send_message(BaseRequest(network_info.id, MessageType.NODE_DOWN), this_address=True)
+            message = decode_message(data, content_type)
+        except Exception as e:
+            self.log_message(f'Could not decode the message: {e!r}', WARNING)
+            return self.reply(400, {'error': 'malformed message'})
+        status, extra = 200, None
+        with self.state_lock:
+            _, actions = handle_message(self.network_info, message)
+            for action in actions:
+                if isinstance(action, Reply):
+                    status, extra = action.status, action.extra
+                else:
+                    self.perform(action)
+
+        elapsed = time.monotonic() - started
+        self.network_info.metrics.message_handled(message, elapsed)
+        if self.logger.enabled(DEBUG):
+            self.log_message('Message handled', DEBUG, message_type=message.message_type.name,
+                             original_id=message.original_id, latency_ms=round(elapsed * 1000, 3))
+        return self.reply(status, extra)
+
+    def render_metrics(self):
+        """
+        :return: text of the /metrics page
+        """
+        info = self.network_info
+        gauges = {
+            'ring_threads': ('Threads of the process', threading.active_count()),
+            'ring_outbound_queue_depth': ('Messages waiting to be sent', self.outbound_queue.stats()['depth']),
+            'ring_is_leader': ('1 if this node is the leader', int(info.leader_id == info.id))
+        }
+        # only the leader knows the ring as it was last colored
+        if info.node_ids is not None:
+            gauges['ring_size'] = ('Nodes in the ring as last colored', len(info.node_ids))
+        counters = seen_cache_metrics(info.seen, gauges)
+        counters.update(failure_detector_metrics(info.failure_detector, gauges))
+        counters.update(coalescer_metrics(info.coalescer))
+        counters.update(timer_metrics(self.timer_manager, gauges))
+        return info.metrics.render(gauges, counters)
+
+    def timer_callback(self, key):
+        """
+        :return: function running the timer job under the key, to be passed to the timer manager
+        """
+        def run():
+            with self.state_lock:
+                run_job(TIMER_JOBS[key](self.network_info), self.perform_in_job)
+            if key == 'ping':
+                self.log_transport_stats()
+        return run
+
+    def perform(self, action):
+        """
+        Carries out an action of the protocol
+        :return: action result passed back to the job
+        """
+        if isinstance(action, Send):
+            return self.send_message_async(action.message, action.this_address)
+        elif isinstance(action, Request):
+            return self.send_message(action.message, action.this_address, action.address, action.timeout).json()
+        elif isinstance(action, StartTimer):
+            return self.timer_manager.add_timer_and_run(action.key, self.timer_callback(action.key), action.purge,
+                                                        action.timeout)
+        elif isinstance(action, StartTimerIfMissing):
+            return self.timer_manager.add_run_if_not_existing(action.key, self.timer_callback(action.key),
+                                                              action.timeout)
+        elif isinstance(action, CancelTimer):
+            return self.timer_manager.cancel_timer(action.key)
+        elif isinstance(action, ShiftNeighbour):
+            return self.shift_right_neighbour(action.address)
+        elif isinstance(action, Log):
+            return self.log_message(action.text, action.level)
+
+    def perform_in_job(self, action):
+        """
+        Carries out an action of a timer job, which holds the state lock - let go while waiting for the reply to a
+        request, the other node (or we ourselves) may be sending to us meanwhile
+        """
+        if not isinstance(action, Request):
+            return self.perform(action)
+        self.state_lock.release()
+        try:
+            return self.perform(action)
+        finally:
+            self.state_lock.acquire()
+
+    def send_message_async(self, message, this_address=False):
+        """
+        Sends the message non-blocking - queues it for the outbound workers, which deliver the messages in order
+        :param message:
+        :param this_address: to ourselves
+        :return: False if the queue was full and the message was dropped
+        """
+        if not self.outbound_queue.submit(message, this_address):
+            self.log_message(f'Outbound queue full, dropping message \n{message}')
+            return False
+        return True
+
+    def batch_messages(self, messages, this_address):
+        """
+        :return: the messages in one BatchRequest, None if the target does not accept it
+        """
+        if not this_address and not self.network_info.right_neighbour_batch:
+            return None
+        return BatchRequest(self.network_info.id, messages)
+
+    def send_failed(self, message, exception):
+        self.log_message(f'Could not send message after retries ({exception}) \n{message}')
+
+    def log_transport_stats(self):
+        if not self.logger.enabled(DEBUG):
+            return
+        pool_stats = self.connection_pool.stats()
+        queue_stats = self.outbound_queue.stats()
+        self.log_message(f'Connection pool hits {pool_stats["hits"]}, misses {pool_stats["misses"]}; '
+                         f'outbound queue depth {queue_stats["depth"]}, sent {queue_stats["sent"]}, '
+                         f'failed {queue_stats["failed"]}, avg latency {queue_stats["latency_avg"] * 1000:.1f} ms, '
+                         f'{queue_stats["batched"]} messages in {queue_stats["batches"]} batches; '
+                         f'duplicates suppressed {self.network_info.coalescer.stats()["suppressed"]}', DEBUG)
+        seen_stats = self.network_info.seen.stats()
+        self.log_message(f'Seen messages {seen_stats["size"]}, dropped again {seen_stats["hits"]} '
+                         f'(hit rate {seen_stats["hit_rate"]:.3f}), evicted {seen_stats["evictions"]}, '
+                         f'expired {seen_stats["expirations"]}', DEBUG)
+        timer_stats = self.timer_manager.stats()
+        self.log_message(f'Timers pending {timer_stats["pending"]}, '
+                         f'drift avg {timer_stats["drift_avg"] * 1000:.1f} ms, '
+                         f'callback latency avg {timer_stats["latency_avg"] * 1000:.1f} ms, '
+                         f'max {timer_stats["latency_max"] * 1000:.1f} ms; threads {threading.active_count()}', DEBUG)
+        detector_stats = self.network_info.failure_detector.stats()
+        self.log_message(f'Failure detector suspicions {detector_stats["suspicions"]}, '
+                         f'false {detector_stats["false_suspicions"]}, ping timeout {detector_stats["timeout"]:.3f} s',
+                         DEBUG)
+        logger_stats = self.logger.stats()
+        self.log_message(f'Log records written {logger_stats["written"]}, dropped {logger_stats["dropped"]}, '
+                         f'sampled out {logger_stats["sampled_out"]}', DEBUG)
+
+    # ----------------------------------------------------------------------------------------------
+    # Utility functions
+    # ----------------------------------------------------------------------------------------------
+
+    def send_message(self, message, this_address=False, address=None, timeout=None):
+        """
+        :param address: (ip, port) of another node than the right neighbour
+        :param timeout: reply timeout in seconds, SEND_TIMEOUT_SEC if not set
+        """
+        sequence = True
+        if this_address:
+            # we always understand our own binary format
+            url, codec_name = self.network_info.get_this_address(), BinaryCodec.name
+        elif address is not None:
+            # we do not know what the other node advertises, the fallback is understood by all
+            url, codec_name = f'http://{address[0]}:{address[1]}/message', DEFAULT_CODEC
         else:
-            log_message('Sending NODE_DOWN message to the right neighbour')
-            send_message(BaseRequest(network_info.id, MessageType.NODE_DOWN))
-
-
-def ping_right_neighbour():
-    try:
-        log_message(f'Pinging right neighbour {network_info.right_neighbour_ip}')
-        send_message(BaseRequest(network_info.id, MessageType.PING))
-        log_message(f'Right neighbour responded to ping')
-
-        # reset the timer
-        timer_manager.cancel_timer('ping')
-        timer_manager.add_timer_and_run('ping', ping_right_neighbour)
-        log_message('-- starting ping in ping_right_neighbour')
-    except BaseException:
-        timer_manager.cancel_timer('ping')
-        log_message(f'Could not ping the neighbour, assuming dead, attempting to recover')
-        recover_neighbour_dead()
-
-
-def send_message_async(message, this_address=False):
+            url, codec_name = self.network_info.get_right_neighbour_address(), self.network_info.right_neighbour_codec
+            sequence = neighbour_keeps_sequence(self.network_info)
+        data, content_type = encode_message(message, codec_name, sequence)
+        started = time.monotonic()
+        try:
+            response = self.connection_pool.post(url, data, headers={'Content-Type': content_type},
+                                                 timeout=timeout or SEND_TIMEOUT_SEC)
+        except Exception:
+            self.network_info.metrics.send_failed(message.message_type.name)
+            raise
+        elapsed = time.monotonic() - started
+        self.network_info.metrics.message_sent(message, elapsed)
+        if self.logger.enabled(DEBUG):
+            self.log_message('Message sent', DEBUG, message_type=message.message_type.name,
+                             original_id=message.original_id, hop_ms=round(elapsed * 1000, 3))
+        return response
+
+    def shift_right_neighbour(self, address=None):
+        """
+        Moves onto the next node in the ring and drops the pooled connections to the old neighbour
+        :param address: (ip, port) to move onto, the next address if None
+        :return: False if there is no other node to move onto
+        """
+        old_address = self.network_info.get_right_neighbour_address()
+        valid = self.network_info.next_neighbour_shift(address)
+        self.connection_pool.close(old_address)
+        return valid
+
+    def reply(self, status=200, extra=None):
+        if status == 200 and extra is None:
+            return self.plain_reply, status
+        return json.dumps(reply_body(self.network_info, extra)), status
+
+    def log_message(self, string, level=INFO, **fields):
+        """
+        Hands the record over to the background logger, does not wait for the output
+        :param fields: structured fields of the record
+        """
+        self.logger.log(string, level, **fields)
+
+
+def create_node(config):
     """
-    Sends the message non-blocking
-    :param message:
-    :param this_address: to ourselves
-    :return:
+    Creates a node without starting it
+    :param config: NodeConfig
+    :return: Node
     """
-    thread = threading.Thread(target=send_message, args=(message, this_address))
-    thread.start()
-
-
-# --------------------------------------------------------------------------------------------------
-# Utility functions
-# --------------------------------------------------------------------------------------------------
-
+    return Node(config)
 
-def send_message(message, this_address=False):
-    return requests.post(
-        network_info.get_right_neighbour_address() if not this_address else network_info.get_this_address(),
-        jsonpickle.encode(message, keys=True), timeout=0.5
-    )
-
-
-def forward_message(message):
-    try:
-        message.sender_id = network_info.id
-        send_message_async(message)
-    except Exception:
-        log_message(f'Could not forward message \n{message}')
-
-
-def sender_this_node(message):
-    return message.original_id == network_info.id
-
-
-def log_message(string):
-    if PRINT_TO_STD:
-        print(f'[{datetime.utcnow()}][{network_info.id}]\t{string}')
-    else:
-        with open('output', 'a', encoding='utf-8') as f:
-            print(f'[{datetime.utcnow()}][{network_info.id}]\t{string}', file=f, flush=True)
-
-# --------------------------------------------------------------------------------------------------
-# FLASK needs to be at the bottom since we need to do some things before it blocks on the run() call
-# --------------------------------------------------------------------------------------------------
-
-
-log_message(f'Node {network_info.id} starting up')
-log_message(f'Node IP: {network_info.ip}:{network_info.port}\nNeighbour IP: {network_info.get_right_neighbour_address()}\nNumber of nodes: {network_info.node_count}')
-
-timer_manager.add_timer_and_run('election_init', send_election_message)
-log_message('-- starting ELECTION timer')
-counters['election_init'] = 0
-
-app = Flask(__name__)
-
-import logging
-logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
+def create_app(node):
+    """
+    Creates the Flask app serving the node's /message and /metrics endpoints
+    """
+    from flask import Flask, request
+    from flask_cors import CORS
 
-@app.route('/message', methods=['POST'])
-def process_message():
-    data = jsonpickle.decode(request.data, keys=True)
+    app = Flask(__name__)
 
-    # simply reply to pings
-    if data.message_type == MessageType.PING:
-        return '{ "id": ' + f'{network_info.id}' + '}', 200
+    @app.route('/message', methods=['POST'])
+    def process_message():
+        return node.process_message(request.data, request.content_type)
 
-    # the leader is down and we prepare for a new election
-    elif data.message_type == MessageType.LEADER_DOWN:
-        network_info.leader_down = True
-        # if we have not sent this message, just forward it and set leader ID to -1
-        if not sender_this_node(data):
-            log_message('LEADER DOWN received, forwarding')
-            network_info.leader_id = -1
-            forward_message(data)
-        # If we have sent this message, we stop sending them and we start sending election messages
-        else:
-            network_info.leader_down = False
-            log_message('LEADER DOWN received at origin')
-            log_message('-- cancelling leader down timer')
-            timer_manager.cancel_timer('leader_down')
-            log_message('-- starting election timer')
-            if timer_manager.check_timer_exists('leader_down'):
-                timer_manager.add_timer_and_run('election_init', send_election_message)
-            else:
-                log_message('-- leader down timer did not exist, election timer was not started')
-
-        return '{ "id": ' + f'{network_info.id}' + '}', 200
-
-    # a node in the ring went down
-    elif data.message_type == MessageType.NODE_DOWN:
-        # if we are not the leader, we just forward the message
-        if not network_info.id == network_info.leader_id:
-            log_message('Received NODE DOWN message, forwarding')
-            forward_message(data)
-            return '{ "id": ' + f'{network_info.id}' + '}', 200
-        # otherwise, we start ID collection, which naturally leads to recoloring
-        else:
-            log_message('Received NODE DOWN message, starting new ID COLLECTION')
-            send_message_async(CollectRequest(network_info.id))
-            return '{ "id": ' + f'{network_info.id}' + '}', 200
-
-    # if the election is ongoing
-    elif data.message_type == MessageType.ELECTION_ROUND:
-        # ignore if leader is already elected
-        if network_info.leader_id != -1:
-            log_message('Ignoring ELECTION message as leader exists')
-            return '{ "id": ' + f'{network_info.id}' + '}', 201
-        # block messages with lower id
-        if data.original_id < network_info.id:
-            # if the leader is down, repeat the message
-            if network_info.leader_down:
-                log_message('Received ELECTION message with lower ID, propagating my own as leader is down')
-                send_message_async(BaseRequest(network_info.id, MessageType.ELECTION_ROUND))
-            else:
-                log_message(f'Received ELECTION message with lower ID, blocking')
-            return '{ "id": ' + f'{network_info.id}' + '}', 200
-        # this node is the leader
-        elif sender_this_node(data):
-            # this is here because of possible repeat messages
-            if network_info.leader_id == -1:
-                # stop sending election messages
-                log_message('-- cancelling election timer')
-                timer_manager.cancel_timer('election_init')
-                network_info.round_trip_made = True
-                # announce leader
-                log_message(f'ELECTION message came back to origin, announcing as leader')
-                send_message_async(BaseRequest(network_info.id, MessageType.LEADER_ELECTED))
-                network_info.leader_id = network_info.id
-
-            return '{ "id": ' + f'{network_info.id}' + '}', 200
-        # forward the message if our ID is lower
-        else:
-            log_message('Forwarding ELECTION message')
-            forward_message(data)
-            return '{ "id": ' + f'{network_info.id}' + '}', 200
-
-    # register the elected leader
-    elif data.message_type == MessageType.LEADER_ELECTED:
-        log_message(f'LEADER_ELECTED message received')
-        # leader is elected, we don't need to send election messages
-        timer_manager.cancel_timer('election_init')
-        log_message('-- election timer stopped as leader was elected')
-
-        exists = timer_manager.add_run_if_not_existing('ping', ping_right_neighbour)
-        if not exists:
-            log_message('-- starting ping in leader_elected')
-
-        # mark leader as iup
-        network_info.round_trip_made = True
-        network_info.leader_down = False
-
-        log_message(f'Setting leader ID')
-        network_info.leader_id = data.original_id
-
-        # if the message returns back to the leader
-        # send a message to collect IDs
-        if sender_this_node(data):
-            log_message(f'LEADER ELECTED message came back to leader')
-            log_message(f'Sending COLLECTION message')
-            send_message_async(CollectRequest(network_info.id))
-        else:
-            log_message('Forwarding LEADER_ELECTED message')
-            forward_message(data)
-
-        return '{ "id": ' + f'{network_info.id}' + '}', 200
-
-    # round trip ids collect message
-    elif data.message_type == MessageType.COLLECT_IDS:
-        # if the message came back
-        if sender_this_node(data):
-            log_message(f'COLLECTION message came back to origin')
-            network_info.node_ids = data.ids
-            log_message(f'Color set to Color.GREEN')
-            log_message(f'Sending COLORING request')
-            color_request = ColorRequest(network_info.id, network_info.node_ids)
-            send_message_async(color_request)
-            pass
-        # add node ID and pass message
-        else:
-            log_message(f'Adding ID to the COLLECTION message')
-            data.ids.append(network_info.id)
-            send_message_async(data)
-
-        return '{ "id": ' + f'{network_info.id}' + '}', 200
-
-    # coloring message
-    elif data.message_type == MessageType.COLORING:
-        # message came back
-        if sender_this_node(data):
-            log_message('COLORING request came back to origin')
-            log_message('Colors are all set')
-            log_message(f'\nNode ID\tColor\n' + '\n'.join(f'{node}\t {color}' for node, color in data.node_color_dict.
-                                                          items()))
-        # this node is getting colored
-        else:
-            log_message(f'Setting color to {data.node_color_dict[network_info.id]}')
-            network_info.color = data.node_color_dict[network_info.id]
-            forward_message(data)
-
-        return '{ "id": ' + f'{network_info.id}' + '}', 200
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return node.render_metrics(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
 
+    CORS(app)
+    return app
 
-CORS(app)
 
-# if ip, listen on all interfaces
-if MODE == 'port':
-    app.run(host='localhost', port=PORT)
-elif MODE == 'ip':
-    app.run(host='0.0.0.0', port=PORT)
+def create_wsgi_app(node, app):
+    """
+    Wraps the Flask app so that the messages from the other nodes skip Flask - building its request and response objects
+    takes far longer than handling a PING. The browser requests (with Origin, for CORS) and the rest go to the Flask app
+    """
+    def wsgi_app(environ, start_response):
+        if environ['PATH_INFO'] != '/message' or environ['REQUEST_METHOD'] != 'POST' or 'HTTP_ORIGIN' in environ:
+            return app(environ, start_response)
+        data = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        body, status = node.process_message(data, environ.get('CONTENT_TYPE'))
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        start_response(f'{status} {HTTPStatus(status).phrase}',
+                       [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+    return wsgi_app
+
+
+def main():
+    socket.setdefaulttimeout(5)
+    if not PRINT_TO_STD:
+        open('output', 'w+', encoding='utf-8').close()
+
+    node = create_node(load_config(MODE, TIMEOUT_SEC))
+    node.start()
+    node.serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""
+asyncio runtime of a node - an alternative to app.py (Flask + threads) speaking the same protocol over HTTP
+
+Everything runs on one event loop: the HTTP server, keep-alive client connections, outbound queue and the timers,
+so the thread count stays flat no matter how many messages are in flight. In port mode one process can also host
+several consecutive nodes of the ring with --local_nodes.
+
+Run with: python async_app.py (ip mode) or python async_app.py --port 5001 --n_nodes 5 [--local_nodes 5]
+"""
+import asyncio
+import json
+import random
+from http import HTTPStatus
+
+from utils import *
+from protocol import *
+
+PRINT_TO_STD = True
+
+MODE = 'ip'
+TIMEOUT_SEC = 30
+SEND_TIMEOUT_SEC = 0.5
+OUTBOUND_QUEUE_SIZE = 256
+SEND_RETRIES = 2
+SEND_BACKOFF_SEC = 0.05
+
+
+class HttpClient:
+    """
+    Minimal keep-alive HTTP/1.1 client on asyncio streams, keeps idle connections per (host, port)
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def post(self, host, port, path, data, content_type, timeout=None):
+        """
+        :param timeout: overrides the client timeout
+        :return: (status, body)
+        """
+        return await asyncio.wait_for(self.__post(host, port, path, data, content_type), timeout or self.timeout)
+
+    def close(self, host, port):
+        for _, writer in self.idle.pop((host, port), []):
+            writer.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    async def __post(self, host, port, path, data, content_type):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        request = (f'POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: {content_type}\r\n'
+                   f'Content-Length: {len(data)}\r\n\r\n').encode('latin-1') + data
+
+        connections = self.idle.setdefault((host, port), [])
+        if connections:
+            self.hits += 1
+            try:
+                return await self.__exchange(connections, *connections.pop(), request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # the other side closed the idle connection in the meantime, try once more on a new one
+                pass
+
+        self.misses += 1
+        reader, writer = await asyncio.open_connection(host, port)
+        return await self.__exchange(connections, reader, writer, request)
+
+    @staticmethod
+    async def __exchange(connections, reader, writer, request):
+        try:
+            writer.write(request)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError('Connection closed by the other side')
+            version, status = status_line.decode('latin-1').split()[:2]
+            headers = await read_headers(reader)
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except BaseException:
+            # the connection is in an unknown state, it cannot be reused
+            writer.close()
+            raise
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            writer.close()
+        else:
+            connections.append((reader, writer))
+        return int(status), body
+
+
+class AsyncNode:
+    def __init__(self, config):
+        node_id = create_node_id(config)
+        self.loop = asyncio.get_running_loop()
+        self.network_info = NetworkInfo(node_id, config.ip, config.node_count, config.port, config.mode,
+                                        config.members)
+        self.network_info.tracer = Tracer(config.trace_sample)
+        self.network_info.coloring = create_coloring(config)
+        self.network_info.election = config.election
+        self.logger = RingLogger(node_id, None if PRINT_TO_STD else 'output', LOG_LEVELS[config.log_level],
+                                 config.log_sample, json_lines=config.log_format == 'json')
+        self.timer_manager = LoopTimerManager(config.timeout_sec, self.loop)
+        self.client = HttpClient(SEND_TIMEOUT_SEC)
+        self.outbound = asyncio.Queue(OUTBOUND_QUEUE_SIZE)
+        # the reply to PING and most other messages never changes, the whole HTTP response is encoded only once
+        self.plain_reply = json.dumps(reply_body(self.network_info)).encode('utf-8')
+        self.plain_response = http_response(200, 'application/json', self.plain_reply, True)
+        # references to the running jobs, the loop only keeps weak ones
+        self.tasks = set()
+
+    async def serve(self):
+        host = self.network_info.ip if self.network_info.mode == 'port' else '0.0.0.0'
+        server = await asyncio.start_server(self.handle_connection, host, self.network_info.port)
+        self.spawn(self.send_outbound())
+
+        self.log_message(f'Node {self.network_info.id} starting up')
+        self.log_message(f'Node IP: {self.network_info.ip}:{self.network_info.port}\n'
+                         f'Neighbour IP: {self.network_info.get_right_neighbour_address()}\n'
+                         f'Number of nodes: {self.network_info.node_count}')
+        self.timer_manager.add_timer_and_run('election_init', self.timer_callback('election_init'))
+        self.log_message('-- starting ELECTION timer')
+        # if the ring is already running, we only get spliced into it
+        self.timer_manager.add_timer_and_run('join', self.timer_callback('join'), timeout=JOIN_DELAY_SEC)
+
+        async with server:
+            await server.serve_forever()
+
+    # ----------------------------------------------------------------------------------------------
+    # Server side
+    # ----------------------------------------------------------------------------------------------
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                content_type = 'application/json'
+                if method == 'POST' and path == '/message':
+                    status, payload = await self.process_message(body, headers.get('content-type'))
+                elif method == 'GET' and path == '/metrics':
+                    status, payload, content_type = 200, self.render_metrics().encode('utf-8'), METRICS_CONTENT_TYPE
+                else:
+                    status, payload = 404, b''
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if status == 200 and payload is self.plain_reply and keep_alive:
+                    writer.write(self.plain_response)
+                else:
+                    writer.write(http_response(status, content_type, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def process_message(self, body, content_type):
+        started = self.loop.time()
+        try:
+            data = decode_message(body, content_type)
+        except Exception as e:
+            # an unknown type code, a truncated body, ... - the sender gets an answer instead of a dropped connection
+            self.log_message(f'Could not decode the message: {e!r}', WARNING)
+            return 400, json.dumps(reply_body(self.network_info, {'error': 'malformed message'})).encode('utf-8')
+        _, actions = handle_message(self.network_info, data)
+
+        status, extra = 200, None
+        for action in actions:
+            if isinstance(action, Reply):
+                status, extra = action.status, action.extra
+            else:
+                await self.perform(action)
+
+        elapsed = self.loop.time() - started
+        self.network_info.metrics.message_handled(data, elapsed)
+        if self.logger.enabled(DEBUG):
+            self.log_message('Message handled', DEBUG, message_type=data.message_type.name,
+                             original_id=data.original_id, latency_ms=round(elapsed * 1000, 3))
+        if status == 200 and extra is None:
+            return status, self.plain_reply
+        return status, json.dumps(reply_body(self.network_info, extra)).encode('utf-8')
+
+    def render_metrics(self):
+        info = self.network_info
+        gauges = {
+            'ring_tasks': ('Running timer jobs and senders of this node', len(self.tasks)),
+            'ring_outbound_queue_depth': ('Messages waiting to be sent', self.outbound.qsize()),
+            'ring_is_leader': ('1 if this node is the leader', int(info.leader_id == info.id))
+        }
+        # only the leader knows the ring as it was last colored
+        if info.node_ids is not None:
+            gauges['ring_size'] = ('Nodes in the ring as last colored', len(info.node_ids))
+        counters = seen_cache_metrics(info.seen, gauges)
+        counters.update(failure_detector_metrics(info.failure_detector, gauges))
+        counters.update(coalescer_metrics(info.coalescer))
+        counters.update(timer_metrics(self.timer_manager, gauges))
+        return info.metrics.render(gauges, counters)
+
+    # ----------------------------------------------------------------------------------------------
+    # Protocol actions
+    # ----------------------------------------------------------------------------------------------
+
+    async def perform(self, action):
+        """
+        Carries out an action of the protocol
+        :return: action result passed back to the job
+        """
+        if isinstance(action, Send):
+            # waits while the queue is full, which slows down whoever is sending to us
+            await self.outbound.put((action.message, action.this_address))
+        elif isinstance(action, Request):
+            return await self.send_message(action.message, action.this_address, action.address, action.timeout)
+        elif isinstance(action, StartTimer):
+            return self.timer_manager.add_timer_and_run(action.key, self.timer_callback(action.key), action.purge,
+                                                        action.timeout)
+        elif isinstance(action, StartTimerIfMissing):
+            return self.timer_manager.add_run_if_not_existing(action.key, self.timer_callback(action.key),
+                                                              action.timeout)
+        elif isinstance(action, CancelTimer):
+            return self.timer_manager.cancel_timer(action.key)
+        elif isinstance(action, ShiftNeighbour):
+            old_neighbour = (self.network_info.right_neighbour_ip, self.network_info.right_neighbour_port)
+            valid = self.network_info.next_neighbour_shift(action.address)
+            self.client.close(*old_neighbour)
+            return valid
+        elif isinstance(action, Log):
+            return self.log_message(action.text, action.level)
+
+    async def run_job(self, job):
+        """
+        Runs a timer job to completion, the asyncio counterpart of protocol.run_job
+        """
+        result, error = None, None
+        while True:
+            try:
+                action = job.throw(error) if error is not None else job.send(result)
+            except StopIteration:
+                return
+            result, error = None, None
+            try:
+                result = await self.perform(action)
+            except Exception as e:
+                error = e
+
+    def timer_callback(self, key):
+        return lambda: self.spawn(self.run_job(TIMER_JOBS[key](self.network_info)))
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # ----------------------------------------------------------------------------------------------
+    # Client side
+    # ----------------------------------------------------------------------------------------------
+
+    async def send_message(self, message, this_address=False, address=None, timeout=None):
+        """
+        Sends the message and waits for the reply
+        :param address: (ip, port) of another node than the right neighbour
+        :param timeout: reply timeout in seconds, SEND_TIMEOUT_SEC if not set
+        :return: reply body
+        """
+        sequence = True
+        if this_address:
+            host, port = self.network_info.ip, self.network_info.port
+            codec_name = BinaryCodec.name
+        elif address is not None:
+            host, port = address
+            codec_name = DEFAULT_CODEC
+        else:
+            host, port = self.network_info.right_neighbour_ip, self.network_info.right_neighbour_port
+            codec_name = self.network_info.right_neighbour_codec
+            sequence = neighbour_keeps_sequence(self.network_info)
+
+        data, content_type = encode_message(message, codec_name, sequence)
+        started = self.loop.time()
+        try:
+            status, body = await self.client.post(host, port, '/message', data, content_type, timeout)
+            if status >= 400:
+                raise ConnectionError(f'Message rejected with status {status}')
+        except Exception:
+            self.network_info.metrics.send_failed(message.message_type.name)
+            raise
+        elapsed = self.loop.time() - started
+        self.network_info.metrics.message_sent(message, elapsed)
+        if self.logger.enabled(DEBUG):
+            self.log_message('Message sent', DEBUG, message_type=message.message_type.name,
+                             original_id=message.original_id, hop_ms=round(elapsed * 1000, 3))
+        return json.loads(body)
+
+    async def send_outbound(self):
+        """
+        Delivers the queued messages to the right neighbour one by one, so they arrive in order. The messages which
+        piled up for the same target meanwhile go out in one batch, if the target accepts it
+        """
+        pending = None
+        while True:
+            message, this_address = pending if pending is not None else await self.outbound.get()
+            pending = None
+
+            messages = [message]
+            while len(messages) < MAX_BATCH_SIZE and not self.outbound.empty():
+                item = self.outbound.get_nowait()
+                if item[1] != this_address:
+                    pending = item
+                    break
+                messages.append(item[0])
+
+            if len(messages) > 1 and (this_address or self.network_info.right_neighbour_batch):
+                await self.send_with_retry(BatchRequest(self.network_info.id, messages), this_address)
+            else:
+                for message in messages:
+                    await self.send_with_retry(message, this_address)
+
+    async def send_with_retry(self, message, this_address):
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                await self.send_message(message, this_address)
+                return
+            except Exception as e:
+                if attempt == SEND_RETRIES:
+                    self.log_message(f'Could not send message after retries ({e!r}) \n{message}')
+                else:
+                    await asyncio.sleep(SEND_BACKOFF_SEC * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def log_message(self, string, level=INFO, **fields):
+        # the records are written by the logger thread, the loop never blocks on the output
+        self.logger.log(string, level, **fields)
+
+
+def http_response(status, content_type, payload, keep_alive):
+    """
+    :return: bytes of the whole HTTP/1.1 response
+    """
+    return (f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+            f'Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1') + payload
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+async def run_nodes(configs):
+    nodes = [AsyncNode(config) for config in configs]
+    await asyncio.gather(*(node.serve() for node in nodes))
+
+
+def main():
+    if not PRINT_TO_STD:
+        open('output', 'w+', encoding='utf-8').close()
+
+    if MODE == 'port':
+        parser = config_parser()
+        # run this many consecutive nodes starting at --port in this process
+        parser.add_argument('--local_nodes', default=1, type=int)
+        args = vars(parser.parse_args())
+        config = load_config(MODE, TIMEOUT_SEC, args)
+        if config.members is None:
+            configs = [config._replace(port=config.port + i) for i in range(args['local_nodes'])]
+        else:
+            # the members which follow us in the member list
+            first = config.members.index((config.ip, config.port))
+            if first is None:
+                raise ValueError(f'{config.ip}:{config.port} is not in the member list')
+            addresses = config.members.addresses[first:first + args['local_nodes']]
+            configs = [config._replace(ip=ip, port=port) for ip, port in addresses]
+    else:
+        configs = [load_config(MODE, TIMEOUT_SEC)]
+    asyncio.run(run_nodes(configs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of the wire codecs - encode/decode time and payload size per message type
+
+Run with: python bench_codec.py [--repeat 2000]
+"""
+import argparse
+import random
+import timeit
+
+from utils import *
+
+RING_SIZES = [10, 100, 1000]
+
+
+def build_messages(n):
+    ids = [random.randint(0, 2_000_000_000) for _ in range(n)]
+    collect = CollectRequest(ids[0])
+    collect.ids = ids
+
+    return {
+        MessageType.PING: BaseRequest(ids[0], MessageType.PING),
+        MessageType.ELECTION_ROUND: BaseRequest(ids[0], MessageType.ELECTION_ROUND),
+        MessageType.NODE_DOWN: NodeDownRequest(ids[0], ids[1]),
+        MessageType.COLLECT_IDS: collect,
+        MessageType.COLORING: ColorRequest(ids[0], ids)
+    }
+
+
+def measure(codec, message, repeat):
+    payload = codec.encode(message)
+    encode_time = timeit.timeit(lambda: codec.encode(message), number=repeat) / repeat
+    decode_time = timeit.timeit(lambda: codec.decode(payload), number=repeat) / repeat
+    return len(payload), encode_time, decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f'{"type":<16}{"N":>6}  {"codec":<12}{"bytes":>10}{"encode us":>12}{"decode us":>12}')
+    for n in RING_SIZES:
+        for message_type, message in build_messages(n).items():
+            for codec in CODECS.values():
+                size, encode_time, decode_time = measure(codec, message, args.repeat)
+                print(f'{message_type.name:<16}{n:>6}  {codec.name:<12}{size:>10}'
+                      f'{encode_time * 1e6:>12.2f}{decode_time * 1e6:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
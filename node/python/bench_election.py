@@ -0,0 +1,114 @@
+"""
+Benchmark of the leader election algorithms - messages and time until the elected leader gets its LEADER ELECTED back,
+for the IDs increasing (sorted) or decreasing (reverse) in the direction the messages go around the ring and in random
+order, in the simulator. Then the re-election after failures - the leader restarted right after going down and a node
+going down while the ring recovers from another one - exits with 1 if a ring stays without a leader
+
+Run with: python bench_election.py [--sizes 10 100 1000 10000] [--elections chang_roberts peterson] [--repeat 3]
+[--scenarios leader_restart double_kill] [--scenario_sizes 10 50]
+"""
+import argparse
+import sys
+
+from simulator import Simulation, run_scenario
+from utils import ELECTIONS
+
+RING_SIZES = [10, 100, 1000, 10000]
+ID_ORDERS = ['sorted', 'reverse', 'random']
+# message types of the election, the pings going on meanwhile are left out
+ELECTION_TYPES = ['ELECTION_ROUND', 'ELECTION_PHASE', 'LEADER_ELECTED']
+# an election taking more messages is stopped, Chang-Roberts on a large ring in reverse order would take hours
+MAX_MESSAGES = 2_000_000
+DURATION_SEC = 3600
+# (kills, restarts) of the failure scenarios, 'leader' is replaced with the index of the leader at the first kill
+SCENARIOS = {
+    'leader_restart': ([(200, 'leader')], [(203, 'leader')]),
+    'double_kill': ([(200, 3), (260, 5)], []),
+}
+SCENARIO_SIZES = [10, 50]
+SCENARIO_DURATION_SEC = 3000
+
+
+def measure(node_count, election, id_order, seed, max_messages=MAX_MESSAGES):
+    """
+    :return: (messages, seconds to the leader), seconds is None if no leader was elected within the message budget
+    """
+    simulation = Simulation(node_count, seed=seed, election=election, id_order=id_order)
+
+    def stop():
+        return simulation.elections or sum(simulation.messages.values()) > max_messages
+
+    simulation.clock.run(DURATION_SEC, stop)
+    messages = sum(simulation.messages.get(name, 0) for name in ELECTION_TYPES)
+    elected = simulation.elections[0][0] if simulation.elections else None
+    # the same leader as the highest ID would be
+    if elected is not None:
+        assert simulation.elections[0][1] == max(node.network_info.id for node in simulation.nodes.values())
+    return messages, elected
+
+
+def leader_index(node_count, election, seed, when):
+    """
+    :return: 1-based index of the leader at the time, the simulation is deterministic for the seed
+    """
+    simulation = Simulation(node_count, seed=seed, election=election)
+    simulation.clock.run(when)
+    for node in simulation.nodes.values():
+        if node.network_info.leader_id == node.network_info.id:
+            return node.network_info.port - 5000
+    return None
+
+
+def recover(node_count, election, scenario, seed):
+    """
+    :return: seconds from the last failure until the ring was colored again, None if it was not
+    """
+    kills, restarts = SCENARIOS[scenario]
+    index = leader_index(node_count, election, seed, kills[0][0])
+    kills = [(when, index if target == 'leader' else target) for when, target in kills]
+    restarts = [(when, index if target == 'leader' else target) for when, target in restarts]
+    result = run_scenario(node_count, kills, SCENARIO_DURATION_SEC, seed=seed, election=election, restarts=restarts)
+    return result['time_to_recoloring'] if result['completed'] else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=RING_SIZES)
+    parser.add_argument('--elections', nargs='+', default=ELECTIONS, choices=ELECTIONS)
+    parser.add_argument('--orders', nargs='+', default=ID_ORDERS, choices=ID_ORDERS)
+    parser.add_argument('--repeat', type=int, default=1, help='number of rings (seeds) per size')
+    parser.add_argument('--max_messages', type=int, default=MAX_MESSAGES, help='stop an election taking more')
+    parser.add_argument('--scenarios', nargs='*', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--scenario_sizes', nargs='+', type=int, default=SCENARIO_SIZES)
+    args = parser.parse_args()
+
+    print(f'{"N":>6}  {"order":<8}{"election":<15}{"messages":>11}{"per node":>10}{"leader s":>11}')
+    for size in args.sizes:
+        for id_order in args.orders:
+            for election in args.elections:
+                results = [measure(size, election, id_order, seed, args.max_messages) for seed in range(args.repeat)]
+                if any(elected is None for _, elected in results):
+                    print(f'{size:>6}  {id_order:<8}{election:<15}{">" + str(args.max_messages):>11}')
+                    continue
+                messages, seconds = (sum(values) / len(values) for values in zip(*results))
+                print(f'{size:>6}  {id_order:<8}{election:<15}{messages:>11.0f}{messages / size:>10.1f}'
+                      f'{seconds:>11.3f}')
+
+    if not args.scenarios:
+        return
+    failed = False
+    print(f'\n{"N":>6}  {"scenario":<16}{"election":<15}{"recovered":>10}{"recovery s":>12}')
+    for size in args.scenario_sizes:
+        for scenario in args.scenarios:
+            for election in args.elections:
+                times = [recover(size, election, scenario, seed) for seed in range(args.repeat)]
+                recovered = [seconds for seconds in times if seconds is not None]
+                failed = failed or len(recovered) < len(times)
+                average = f'{sum(recovered) / len(recovered):>12.3f}' if recovered else f'{"-":>12}'
+                print(f'{size:>6}  {scenario:<16}{election:<15}{f"{len(recovered)}/{len(times)}":>10}{average}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark of the recoloring after a node goes down - hops and bytes of the full cycle (NODE_DOWN, COLLECT_IDS around
+the ring, COLORING of every node) against the delta coloring of only the changed nodes, in the simulator
+
+Run with: python bench_recolor.py [--sizes 10 100 1000] [--repeat 3]
+"""
+import argparse
+import sys
+
+from simulator import run_scenario
+
+RING_SIZES = [10, 100, 1000]
+KILL_TIME = 200
+# message types taking part in the recoloring, the pings going on meanwhile are left out
+RECOLORING_TYPES = ['NODE_DOWN', 'COLLECT_IDS', 'COLORING']
+
+
+def measure(node_count, seed, delta_recoloring):
+    """
+    Kills a node in the middle of the ring, the next one if that happens to be the leader
+    :return: (hops, bytes, seconds to recolor), seconds is None if the ring was not colored again within the run
+    """
+    for index in range(node_count // 2, node_count + 1):
+        result = run_scenario(node_count, [(KILL_TIME, str(index))], KILL_TIME + 3600, seed=seed,
+                              delta_recoloring=delta_recoloring)
+        if 'LEADER_DOWN' not in result['messages_since_kill']:
+            break
+    hops = sum(result['messages_since_kill'].get(name, 0) for name in RECOLORING_TYPES)
+    size = sum(result['bytes_since_kill'].get(name, 0) for name in RECOLORING_TYPES)
+    return hops, size, result['time_to_recoloring'] if result['completed'] else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=RING_SIZES)
+    parser.add_argument('--repeat', type=int, default=3, help='number of rings (seeds) per size')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"N":>6}  {"mode":<6}{"hops":>10}{"bytes":>12}{"recolored":>11}{"recolored s":>13}')
+    for size in args.sizes:
+        for delta_recoloring in (False, True):
+            results = [measure(size, seed, delta_recoloring) for seed in range(args.repeat)]
+            hops, size_bytes = (sum(values) / len(values) for values in list(zip(*results))[:2])
+            # the runs which did not recolor count into the hops and bytes, but not into the time
+            recolored = [seconds for _, _, seconds in results if seconds is not None]
+            failed = failed or len(recolored) < len(results)
+            average = f'{sum(recolored) / len(recolored):>13.3f}' if recolored else f'{"-":>13}'
+            print(f'{size:>6}  {"delta" if delta_recoloring else "full":<6}{hops:>10.0f}{size_bytes:>12.0f}'
+                  f'{f"{len(recolored)}/{len(results)}":>11}{average}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+"""
+Load generator and soak test of the /message endpoint - fires a mix of PING, ELECTION_ROUND, COLLECT_IDS and COLORING
+messages at a node in port mode and reports the throughput, p50/p99 latency, peak RSS and thread count of the node, per
+interval and for the whole run
+
+With --spawn the node is started here, in port mode with a member list making a sink run by the load generator its
+right neighbour - the forwarded messages go the full way through the node instead of piling up on a dead neighbour.
+Without it the node at --port has to be running already, --pid lets its memory and threads be read
+
+Run with: python loadgen.py --spawn app [--duration 60] [--concurrency 8] [--mix ping=70,election=10,collect=10,
+coloring=10] [--ids 1000] [--json results.json] [--baseline baseline.json]
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import *
+
+PORT = 5001
+NODE_ID = 1_000_000
+SINK_ID = 2_000_000
+DURATION_SEC = 60
+INTERVAL_SEC = 10
+CONCURRENCY = 8
+COLLECT_ID_COUNT = 1000
+DEFAULT_MIX = 'ping=70,election=10,collect=10,coloring=10'
+REQUEST_TIMEOUT_SEC = 5
+STARTUP_TIMEOUT_SEC = 15
+# relative change of the throughput, p99 latency or peak RSS against the baseline taken as a regression
+TOLERANCE = 0.2
+# latency histogram buckets grow by this factor, the percentiles are exact to about 1 %
+BUCKET_BASE = 1.02
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets - constant memory however long the soak runs
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = math.ceil(math.log(max(seconds, 1e-6) * 1e6, BUCKET_BASE))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        :param p: 0 - 100
+        :return: upper bound of the bucket holding the percentile in seconds, None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(BUCKET_BASE ** index / 1e6, self.max)
+        return self.max
+
+
+class Recorder:
+    """
+    Latencies and errors of all the workers, per message type, swapped out at the end of every interval
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.interval = {}
+        self.errors = 0
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.interval.setdefault(name, Histogram()).record(seconds)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def swap(self):
+        """
+        :return: (histograms per message type, errors) since the last swap
+        """
+        with self.lock:
+            interval, errors = self.interval, self.errors
+            self.interval, self.errors = {}, 0
+        return interval, errors
+
+
+class Sink:
+    """
+    Right neighbour of the spawned node, answers every message the way a node does and counts them
+    """
+    def __init__(self, port):
+        self.received = 0
+        self.lock = threading.Lock()
+        sink = self
+        body = json.dumps({'id': SINK_ID, 'codecs': SUPPORTED_CODECS,
+                           'accepts': [MessageType.BATCH.value, TRACE, SEQUENCE], 'leader_id': -1}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with sink.lock:
+                    sink.received += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        # the node is stopped in the middle of sending at the end of the run
+        self.server.handle_error = lambda request, client_address: None
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def build_messages(id_count, seed):
+    """
+    One message of every type, the senders and IDs are random but never the spawned node's own ID - a message carrying
+    it would look like it came back around the ring
+    :param id_count: IDs in the COLLECT_IDS and COLORING messages
+    :return: dict name -> message
+    """
+    rng = random.Random(seed)
+
+    def other_id():
+        node_id = rng.randint(0, 2_000_000_000)
+        return node_id if node_id != NODE_ID else node_id + 1
+
+    ids = [other_id() for _ in range(id_count)]
+    collect = CollectRequest(ids[0], ('localhost', PORT))
+    collect.ids = ids
+    collect.addresses = [('localhost', PORT + i % 1000) for i in range(id_count)]
+    return {
+        'ping': BaseRequest(SINK_ID, MessageType.PING),
+        'election': BaseRequest(other_id(), MessageType.ELECTION_ROUND),
+        'collect': collect,
+        'coloring': ColorRequest(ids[0], ids + [NODE_ID]),
+    }
+
+
+class Payloads:
+    """
+    Encoded messages, each send gets a fresh sequence number so that the node does not drop it as already seen
+    """
+    def __init__(self, messages, codec_name):
+        self.messages = messages
+        self.codec_name = codec_name
+        self.encoded = {name: encode_message(message, codec_name) for name, message in messages.items()}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        :return: (payload, content type)
+        """
+        if self.codec_name == BinaryCodec.name:
+            # the sequence number is right after the fixed header, patched in instead of encoding the message again
+            data, content_type = self.encoded[name]
+            data = bytearray(data)
+            BinaryCodec.SEQUENCE.pack_into(data, BinaryCodec.HEADER.size, next(MESSAGE_SEQUENCE) & 0xFFFFFFFF)
+            return bytes(data), content_type
+        with self.lock:
+            message = self.messages[name]
+            message.sequence = next(MESSAGE_SEQUENCE)
+            return encode_message(message, self.codec_name)
+
+
+def parse_mix(text):
+    """
+    :param text: 'ping=70,election=10,...'
+    :return: (names, weights)
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('ping', 'election', 'collect', 'coloring'):
+            raise ValueError(f'Unknown message type in the mix: {name}')
+        mix[name.strip()] = float(weight or 1)
+    return list(mix), list(mix.values())
+
+
+def worker(number, args, payloads, recorder, deadline):
+    rng = random.Random(args.seed + number)
+    names, weights = parse_mix(args.mix)
+    connection = None
+    # with --rate every worker sends on a fixed schedule, the latency is counted from the planned send so that a slow
+    # reply delaying the next sends shows in the percentiles
+    period = args.concurrency / args.rate if args.rate else 0
+    planned = time.perf_counter() + rng.random() * period
+    while True:
+        if period:
+            now = time.perf_counter()
+            if planned > now:
+                time.sleep(planned - now)
+            started = planned
+            planned += period
+        else:
+            started = time.perf_counter()
+        if time.monotonic() >= deadline:
+            break
+        name = rng.choices(names, weights)[0]
+        data, content_type = payloads.get(name)
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(args.host, args.port, timeout=REQUEST_TIMEOUT_SEC)
+            connection.request('POST', '/message', data, {'Content-Type': content_type})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                recorder.error()
+                continue
+        except (OSError, http.client.HTTPException):
+            recorder.error()
+            if connection is not None:
+                connection.close()
+            connection = None
+            continue
+        recorder.record(name, time.perf_counter() - started)
+    if connection is not None:
+        connection.close()
+
+
+def process_stats(pid):
+    """
+    :return: (RSS MB, peak RSS MB, threads) of the process from /proc, None for each if not available
+    """
+    if pid is None:
+        return None, None, None
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                stats[name] = value.split()[0] if value.split() else None
+    except OSError:
+        return None, None, None
+    rss = round(int(stats['VmRSS']) / 1024, 1) if stats.get('VmRSS') else None
+    peak = round(int(stats['VmHWM']) / 1024, 1) if stats.get('VmHWM') else None
+    threads = int(stats['Threads']) if stats.get('Threads') else None
+    return rss, peak, threads
+
+
+def summarize(histograms, errors, seconds):
+    total = Histogram()
+    for histogram in histograms.values():
+        total.merge(histogram)
+    result = {'requests': total.count, 'errors': errors, 'throughput': round(total.count / seconds, 1)}
+    result.update(latencies(total))
+    result['by_type'] = {name: dict(requests=histogram.count, **latencies(histogram))
+                         for name, histogram in sorted(histograms.items())}
+    return result
+
+
+def latencies(histogram):
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {'p50_ms': ms(histogram.percentile(50)), 'p99_ms': ms(histogram.percentile(99)),
+            'max_ms': ms(histogram.max if histogram.count else None)}
+
+
+def spawn_node(args):
+    """
+    Starts the node in port mode with the sink as its right neighbour
+    :return: Popen
+    """
+    members = f'localhost:{args.port} {NODE_ID},localhost:{args.sink_port} {SINK_ID}'
+    code = f'import {args.spawn} as node; node.MODE = "port"; node.main()'
+    log = open(args.node_log, 'w', encoding='utf-8') if args.node_log else subprocess.DEVNULL
+    command = [sys.executable, '-c', code, '--port', str(args.port), '--log_level', args.log_level]
+    if args.spawn == 'app':
+        command += ['--server', args.server, '--threads', str(args.threads)]
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=dict(os.environ, RING_MEMBERS=members), stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(args, process):
+    ping, content_type = encode_message(BaseRequest(SINK_ID, MessageType.PING))
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'The node exited with {process.returncode}')
+        try:
+            connection = http.client.HTTPConnection(args.host, args.port, timeout=1)
+            connection.request('POST', '/message', ping, {'Content-Type': content_type})
+            connection.getresponse().read()
+            connection.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    raise RuntimeError(f'The node at {args.host}:{args.port} is not answering')
+
+
+def compare(result, baseline, tolerance):
+    """
+    :return: list of regressions against the baseline result, empty if none
+    """
+    regressions = []
+    old, new = baseline['summary'], result['summary']
+    if old.get('throughput') and new['throughput'] < old['throughput'] * (1 - tolerance):
+        regressions.append(f'throughput {new["throughput"]}/s, baseline {old["throughput"]}/s')
+    for key, unit in (('p99_ms', 'ms'), ('peak_rss_mb', 'MB'), ('max_threads', '')):
+        if old.get(key) and new.get(key) is not None and new[key] > old[key] * (1 + tolerance):
+            regressions.append(f'{key} {new[key]}{unit}, baseline {old[key]}{unit}')
+    return regressions
+
+
+def run(args):
+    payloads = Payloads(build_messages(args.ids, args.seed), args.codec)
+    process = sink = None
+    if args.spawn:
+        sink = Sink(args.sink_port)
+        sink.start()
+        process = spawn_node(args)
+    pid = process.pid if process is not None else args.pid
+    try:
+        wait_ready(args, process)
+        recorder = Recorder()
+        started = time.monotonic()
+        deadline = started + args.duration
+        workers = [threading.Thread(target=worker, args=(number, args, payloads, recorder, deadline), daemon=True)
+                   for number in range(args.concurrency)]
+        for thread in workers:
+            thread.start()
+
+        intervals = []
+        totals = {}
+        errors = 0
+        peak_rss = max_threads = None
+        print(f'{"s":>6}{"req/s":>10}{"errors":>8}{"p50 ms":>9}{"p99 ms":>9}{"RSS MB":>9}{"threads":>9}')
+        previous = started
+        while any(thread.is_alive() for thread in workers):
+            time.sleep(max(0.0, min(args.interval, deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                # the last interval includes the replies still on their way
+                for thread in workers:
+                    thread.join()
+            now = time.monotonic()
+            histograms, interval_errors = recorder.swap()
+            rss, peak, threads = process_stats(pid)
+            interval = summarize(histograms, interval_errors, now - previous)
+            interval.update(second=round(now - started, 1), rss_mb=rss, threads=threads)
+            del interval['by_type']
+            intervals.append(interval)
+            for name, histogram in histograms.items():
+                totals.setdefault(name, Histogram()).merge(histogram)
+            errors += interval_errors
+            if peak is not None:
+                peak_rss = max(peak_rss or 0, peak)
+            if threads is not None:
+                max_threads = max(max_threads or 0, threads)
+            previous = now
+            print(f'{interval["second"]:>6.0f}{interval["throughput"]:>10.1f}{interval_errors:>8}'
+                  f'{interval["p50_ms"] or 0:>9.2f}{interval["p99_ms"] or 0:>9.2f}{rss or 0:>9.1f}{threads or 0:>9}')
+
+        summary = summarize(totals, errors, time.monotonic() - started)
+        summary.update(peak_rss_mb=peak_rss, max_threads=max_threads)
+        if sink is not None:
+            summary['forwarded'] = sink.received
+        config = {key: value for key, value in vars(args).items() if key not in ('json', 'baseline', 'node_log')}
+        return {'config': config, 'intervals': intervals, 'summary': summary}
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if sink is not None:
+            sink.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawn', choices=['app', 'async_app'], help='start the node here, otherwise it has to run')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--sink_port', type=int, default=PORT + 1, help='right neighbour of the spawned node')
+    parser.add_argument('--pid', type=int, help='process of the running node, for its memory and threads')
+    parser.add_argument('--log_level', default='WARNING', choices=list(LOG_LEVELS), help='of the spawned node')
+    parser.add_argument('--node_log', help='output of the spawned node, discarded if not set')
+    parser.add_argument('--server', default='werkzeug', choices=SERVERS, help='HTTP server of the spawned app')
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS, help='request threads of the spawned app')
+    parser.add_argument('--duration', type=float, default=DURATION_SEC, help='seconds')
+    parser.add_argument('--interval', type=float, default=INTERVAL_SEC, help='seconds between the reports')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='connections sending at the same time')
+    parser.add_argument('--rate', type=float, help='messages per second in total, as fast as possible if not set')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='message types and their weights')
+    parser.add_argument('--ids', type=int, default=COLLECT_ID_COUNT, help='IDs in COLLECT_IDS and COLORING')
+    parser.add_argument('--codec', default=BinaryCodec.name, choices=SUPPORTED_CODECS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--baseline', help='results of an earlier run, exits with 1 on a regression against them')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative change taken as a regression')
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    result = run(args)
+    summary = result['summary']
+    print(f'total {summary["requests"]} messages, {summary["throughput"]}/s, {summary["errors"]} errors, '
+          f'p50 {summary["p50_ms"]} ms, p99 {summary["p99_ms"]} ms, peak RSS {summary["peak_rss_mb"]} MB, '
+          f'threads {summary["max_threads"]}')
+    for name, stats in summary['by_type'].items():
+        print(f'  {name:<10}{stats["requests"]:>9} p50 {stats["p50_ms"]} ms, p99 {stats["p99_ms"]} ms')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,888 @@
+"""
+Ring protocol of a node, independent of the HTTP server, client and timers used to run it
+
+The functions here never do any I/O - they update the node state (NetworkInfo) and hand back actions for the
+runtime to carry out. handle_message() processes one received message and returns its actions, the timer jobs
+are generators yielding the actions one at a time. The result of an action (e.g. the reply to a Request) is sent
+back into the job, a failed action is thrown into it.
+"""
+from collections import namedtuple
+
+from utils import *
+
+# send the message to the right neighbour (or ourselves) without waiting for it to be processed
+Send = namedtuple('Send', ['message', 'this_address'], defaults=[False])
+# send the message and wait for the reply - the job gets the reply body (dict) back
+# address is (ip, port) of a node other than the right neighbour, timeout overrides the default reply timeout
+Request = namedtuple('Request', ['message', 'this_address', 'address', 'timeout'], defaults=[False, None, None])
+# start the timer job under the key, if a timer with the key is pending it is only replaced with purge set
+# timeout overrides the default timer timeout
+StartTimer = namedtuple('StartTimer', ['key', 'purge', 'timeout'], defaults=[False, None])
+# start the timer job only if no timer with the key is pending or running - the job gets back whether one was
+StartTimerIfMissing = namedtuple('StartTimerIfMissing', ['key', 'timeout'], defaults=[None])
+CancelTimer = namedtuple('CancelTimer', ['key'])
+# move onto the next node in the ring, or the given (ip, port) - the job gets back False if there is no other node
+ShiftNeighbour = namedtuple('ShiftNeighbour', ['address'], defaults=[None])
+# log the text, DEBUG is for the hot paths (pings), which are only logged when debugging
+Log = namedtuple('Log', ['text', 'level'], defaults=[INFO])
+# reply to the received message with a status other than 200 and/or extra fields in the reply body
+Reply = namedtuple('Reply', ['status', 'extra'], defaults=[200, None])
+
+# how many times we try to contact the initial right neighbour before moving onto the next one
+# with the default 30s timer that is 12 minutes
+MAX_ELECTION_ATTEMPTS = 24
+# how many times in a row a suspected neighbour can be kept alive by the indirect ping - if we cannot reach it
+# ourselves for this long, it is no use as a neighbour anyway
+MAX_CLEARED_SUSPICIONS = 3
+# the neighbour pings the node after it once per probe interval plus the round trip and the timer delay, which under
+# load can take well over the interval - it counts as heard of within this many probe intervals
+HEARD_OF_INTERVALS = 2
+# a started node first tries to join a running ring after this many seconds, once its server is up, and tries again
+# after the retry time if it was not spliced in
+JOIN_DELAY_SEC = 0.5
+JOIN_RETRY_SEC = 5
+# messages the seen cache does not remember - the ones only sent to the neighbour and replied to (the batch itself,
+# not its messages), and JOIN, which passes some nodes twice on its way to the leader and is bounded by its hop count
+NOT_REMEMBERED = {MessageType.PING, MessageType.PROBE, MessageType.BATCH, MessageType.JOIN}
+
+
+def handle_message(state, message):
+    """
+    Processes a message received from the left neighbour (or ourselves)
+    :param state: NetworkInfo of this node, updated in place
+    :param message: decoded message
+    :return: (state, list of actions)
+    """
+    state.failure_detector.heard_from(message.sender_id)
+    return state, coalesce(state, message_actions(state, message))
+
+
+def message_actions(state, message):
+    """
+    :return: list of actions the message leads to, before the duplicates are dropped
+    """
+    out = []
+    # a message coming again - retried after its reply got lost, or going around the ring again after its origin went
+    # down
+    if message.message_type not in NOT_REMEMBERED and state.seen.seen(message):
+        out.append(Log(f'Dropping {message.message_type.name} message of {message.original_id} seen before', DEBUG))
+        return out
+    state.tracer.received(state.id, message)
+
+    # simply reply to pings
+    if message.message_type == MessageType.PING:
+        pass
+
+    # several messages in one request, processed in order - only the reply to the batch itself is sent
+    elif message.message_type == MessageType.BATCH:
+        for inner in message.messages:
+            out.extend(action for action in message_actions(state, inner) if not isinstance(action, Reply))
+
+    # indirect ping - tell when we last heard from the node
+    elif message.message_type == MessageType.PROBE:
+        out.append(Reply(extra={'last_heard': state.failure_detector.last_heard(message.target_id)}))
+
+    # the leader is down and we prepare for a new election
+    elif message.message_type == MessageType.LEADER_DOWN:
+        state.leader_down = True
+        state.metrics.election_started()
+        # if we have not sent this message, just forward it and set leader ID to -1
+        if not sender_this_node(state, message):
+            out.append(Log('LEADER DOWN received, forwarding'))
+            state.leader_id = -1
+            out.append(forward(state, message))
+        # If we have sent this message, we stop sending them and we start sending election messages
+        else:
+            state.leader_down = False
+            out.append(Log('LEADER DOWN received at origin'))
+            out.append(Log('-- cancelling leader down timer'))
+            out.append(CancelTimer('leader_down'))
+            out.append(Log('-- starting election timer'))
+            out.append(StartTimer('election_init'))
+
+    # a node in the ring went down
+    elif message.message_type == MessageType.NODE_DOWN:
+        # the message went around the whole ring without reaching the leader - the leader went down together with the
+        # nodes we skipped, so we start the same way as if it was our neighbour
+        if not state.id == state.leader_id and sender_this_node(state, message):
+            out.append(Log('NODE DOWN message came back without reaching the leader, leader is down', WARNING))
+            state.leader_id = -1
+            out.append(StartTimer('leader_down'))
+            out.append(Log('-- started leader down timer'))
+        # if we are not the leader, we just forward the message
+        elif not state.id == state.leader_id:
+            out.append(Log('Received NODE DOWN message, forwarding'))
+            out.append(forward(state, message))
+        else:
+            state.metrics.failure_detected()
+            # recolor only the nodes whose color changed, if we know which nodes went down - not while the last
+            # delta is still on its way, it may have been lost with the node, and not with an older node in the ring
+            # (it did not add its address), which expects its own color in every COLORING
+            node_ids = None
+            if state.delta_recoloring and not state.delta_pending and state.node_addresses is not None:
+                node_ids = remaining_node_ids(state, message)
+
+            if node_ids is not None:
+                coloring = ColorRequest(state.id, node_ids, state.node_ids, strategy=state.coloring)
+                state.node_ids = node_ids
+                if coloring.node_ids:
+                    out.append(Log(f'Received NODE DOWN message, sending COLORING of '
+                                   f'{len(coloring.node_ids)} changed nodes'))
+                    state.delta_pending = True
+                    out.append(Send(traced(state, coloring)))
+                else:
+                    out.append(Log('Received NODE DOWN message, no colors changed'))
+                    state.metrics.ring_colored()
+            # otherwise, we start ID collection, which naturally leads to recoloring
+            else:
+                out.append(Log('Received NODE DOWN message, starting new ID COLLECTION'))
+                out.append(Send(traced(state, CollectRequest(state.id, (state.ip, state.port)))))
+
+    # if the election is ongoing - handled by the algorithm the message belongs to
+    elif message.message_type in ELECTIONS_BY_MESSAGE_TYPE:
+        out.extend(ELECTIONS_BY_MESSAGE_TYPE[message.message_type].handle(state, message))
+
+    # register the elected leader
+    elif message.message_type == MessageType.LEADER_ELECTED:
+        out.append(Log(f'LEADER_ELECTED message received'))
+        # leader is elected, we don't need to send election messages
+        out.append(CancelTimer('election_init'))
+        out.append(Log('-- election timer stopped as leader was elected'))
+        out.append(StartTimerIfMissing('ping', state.failure_detector.probe_interval))
+
+        # mark leader as up
+        state.round_trip_made = True
+        state.leader_down = False
+        ELECTION_ALGORITHMS[state.election].finished(state)
+
+        out.append(Log(f'Setting leader ID'))
+        state.leader_id = message.original_id
+        state.metrics.leader_elected()
+
+        # if the message returns back to the leader
+        # send a message to collect IDs
+        if sender_this_node(state, message):
+            out.append(Log(f'LEADER ELECTED message came back to leader'))
+            out.extend(report_trace(message))
+            out.append(Log(f'Sending COLLECTION message'))
+            out.append(Send(traced(state, CollectRequest(state.id, (state.ip, state.port)))))
+        else:
+            out.append(Log('Forwarding LEADER_ELECTED message'))
+            out.append(forward(state, message))
+
+    # round trip ids collect message
+    elif message.message_type == MessageType.COLLECT_IDS:
+        # if the message came back
+        if sender_this_node(state, message):
+            out.append(Log(f'COLLECTION message came back to origin'))
+            out.extend(report_trace(message))
+            state.node_ids = message.ids
+            state.delta_pending = False
+            # the addresses only make it around if all the nodes know to add them
+            state.node_addresses = None
+            if message.addresses is not None and len(message.addresses) == len(message.ids):
+                state.node_addresses = dict(zip(message.ids, message.addresses))
+                state.set_ring(message.ids, message.addresses)
+            coloring = ColorRequest(state.id, state.node_ids, node_addresses=state.node_addresses,
+                                    strategy=state.coloring)
+            state.color = coloring.color_of(state.id)
+            out.append(Log(f'Color set to {state.color}'))
+            out.append(Log(f'Sending COLORING request'))
+            out.append(Send(traced(state, coloring)))
+        # add node ID and pass message
+        else:
+            out.append(Log(f'Adding ID to the COLLECTION message'))
+            message.ids.append(state.id)
+            if message.addresses is not None:
+                message.addresses.append((state.ip, state.port))
+            out.append(forward(state, message))
+
+    # a restarted node wants to get back into the ring
+    elif message.message_type == MessageType.JOIN:
+        # we are the joining node
+        if sender_this_node(state, message):
+            # the notice went around the whole ring without finding the leader, or a repeated splice
+            if message.predecessor_id is None or state.leader_id != -1:
+                out.append(Log('JOIN message came back, dropping'))
+            else:
+                out.append(Log(f'Spliced into the ring after {message.predecessor_id}'))
+                out.append(CancelTimer('join'))
+                out.append(CancelTimer('election_init'))
+                state.round_trip_made = True
+                if message.successor is not None:
+                    out.append(ShiftNeighbour(tuple(message.successor)))
+                out.append(StartTimerIfMissing('ping', state.failure_detector.probe_interval))
+                # we were the leader before the restart, nobody else notices it is gone
+                if message.replaced_id == message.leader_id or message.leader_address is not None and \
+                        tuple(message.leader_address) == (state.ip, state.port):
+                    out.append(Log('The leader the ring knows was us before the restart, leader is down', WARNING))
+                    out.append(StartTimer('leader_down'))
+                else:
+                    state.leader_id = message.leader_id
+                    state.leader_down = False
+                    # the leader colors us once it knows where we are
+                    state.join_notice = message
+                    out.append(StartTimer('join_notify', timeout=0))
+        # the joining node is in the ring already, the leader colors it
+        elif message.predecessor_id is not None:
+            if state.id == state.leader_id:
+                out.extend(recolor_joined(state, message))
+            else:
+                out.append(forward(state, message))
+        # there is no ring to join, the joining node takes part in the election
+        elif state.leader_id == -1:
+            out.append(Reply(extra={'leader_id': -1}))
+        # the joining node belongs between us and the right neighbour - it takes over our right neighbour and we send
+        # to it from now on
+        elif joins_after(state, message.address):
+            out.append(Log(f'Splicing the node at {message.address[0]}:{message.address[1]} in after us'))
+            neighbour = (state.right_neighbour_ip, state.right_neighbour_port)
+            rejoined = neighbour == tuple(message.address)
+            message.predecessor_id = state.id
+            message.leader_id = state.leader_id
+            # still the same node to us, it restarted before we noticed - it keeps its right neighbour
+            if rejoined and state.right_neighbour_id not in (-1, message.original_id):
+                message.replaced_id = state.right_neighbour_id
+            message.successor = None if rejoined else neighbour
+            message.leader_address = leader_address(state)
+            out.append(ShiftNeighbour(tuple(message.address)))
+            out.append(forward(state, message))
+            out.append(Reply(extra={'leader_id': state.leader_id}))
+        # went around the whole ring without finding the place, the joining node tries again later
+        elif message.hops >= state.node_count:
+            out.append(Log('JOIN message found no place in the ring, dropping', WARNING))
+        else:
+            out.append(Log('Forwarding JOIN message'))
+            message.hops += 1
+            out.append(forward(state, message))
+            out.append(Reply(extra={'leader_id': state.leader_id}))
+
+    # coloring message
+    elif message.message_type == MessageType.COLORING:
+        # message came back
+        if sender_this_node(state, message):
+            out.append(Log('COLORING request came back to origin'))
+            out.extend(report_trace(message))
+            out.append(Log('Colors are all set'))
+            if message.delta:
+                state.delta_pending = False
+                # the leader is colored too, if its color changed
+                state.color = message.color_of(state.id) or state.color
+            state.metrics.ring_colored()
+            out.append(Log(f'\nNode ID\tColor\n' + '\n'.join(f'{node}\t {color}' for node, color in
+                                                             message.colors())))
+        # this node is getting colored, a delta coloring skips the nodes keeping their color
+        else:
+            color = message.color_of(state.id)
+            if color is not None:
+                out.append(Log(f'Setting color to {color}'))
+                state.color = color
+            state.metrics.ring_colored()
+            # the full coloring carries the whole ring, the fingers are built from it
+            if message.addresses is not None:
+                state.set_ring(message.node_ids, message.addresses)
+            out.append(forward(state, message))
+
+    return out
+
+
+def coalesce(state, actions):
+    """
+    Leaves out sending the duplicate control messages
+    """
+    out = []
+    for action in actions:
+        if isinstance(action, Send) and not state.coalescer.admit(action.message):
+            out.append(Log(f'Dropping duplicate {action.message.message_type.name} message '
+                           f'of {action.message.original_id}', DEBUG))
+        else:
+            out.append(action)
+    return out
+
+
+# --------------------------------------------------------------------------------------------------
+# Election algorithms
+# --------------------------------------------------------------------------------------------------
+
+
+class ChangRoberts:
+    """
+    Every node sends its ID around the ring, a node passes on only the IDs higher than its own and the node whose ID
+    comes back is the leader. N messages with the IDs increasing along the ring, N^2 / 2 with them decreasing
+    """
+    message_type = MessageType.ELECTION_ROUND
+
+    def start(self, state):
+        """
+        :return: message the election timer sends to the right neighbour, None to send nothing this time
+        """
+        return BaseRequest(state.id, MessageType.ELECTION_ROUND)
+
+    def failed(self, state):
+        """
+        Called when the message from start() could not be sent
+        """
+
+    def finished(self, state):
+        """
+        Called once the leader is known
+        """
+
+    def handle(self, state, message):
+        """
+        :return: list of actions of the election message
+        """
+        out = []
+        # ignore if leader is already elected
+        if state.leader_id != -1:
+            out.append(Log('Ignoring ELECTION message as leader exists'))
+            out.append(Reply(201))
+        # block messages with lower id
+        elif message.original_id < state.id:
+            # if the leader is down, repeat the message
+            if state.leader_down:
+                out.append(Log('Received ELECTION message with lower ID, propagating my own as leader is down'))
+                out.append(Send(BaseRequest(state.id, MessageType.ELECTION_ROUND)))
+            else:
+                out.append(Log(f'Received ELECTION message with lower ID, blocking'))
+        # this node is the leader
+        elif sender_this_node(state, message):
+            # this is here because of possible repeat messages
+            if state.leader_id == -1:
+                out.append(Log(f'ELECTION message came back to origin, announcing as leader'))
+                out.extend(announce_leader(state))
+        # forward the message if our ID is lower
+        else:
+            out.append(Log('Forwarding ELECTION message'))
+            out.append(forward(state, message))
+        return out
+
+
+class Peterson:
+    """
+    Peterson's election for a unidirectional ring, at most 2N log N + O(N) messages for any order of the IDs
+
+    Every active node sends the ID it stands for (FIRST) and passes on the one it receives from the nearest active
+    node before it (SECOND). Having both IDs from before it, the node stays active for the next phase with the first
+    one if it is the highest of the three, otherwise it only relays the messages from then on - at least half of the
+    active nodes drop out in every phase. The last active node gets its own FIRST back and sends the ID, which is the
+    highest in the ring, around until its node announces itself as the leader.
+
+    Relies on the messages between two nodes coming in order. If an election does not move on for a whole election
+    timer, the node starts it again in a new round, the messages of the older rounds are dropped - except the FIRST of
+    a node behind in the rounds, which makes an idle node start the current round.
+    """
+    message_type = MessageType.ELECTION_PHASE
+
+    def start(self, state):
+        # a node waiting for the messages before it does not start again, unless nothing came since the last time
+        if state.election_tid is not None:
+            if state.election_progress:
+                state.election_progress = False
+                return None
+            state.election_round += 1
+            self.reset(state)
+        state.election_tid = state.id
+        return ElectionPhaseRequest(state.id, state.election_round, ElectionPhaseRequest.FIRST, state.id)
+
+    def failed(self, state):
+        # our FIRST did not go out, we start again next time
+        if state.election_ntid is None and not state.election_relay:
+            state.election_tid = None
+
+    def finished(self, state):
+        # the next election is a new round
+        if state.election_tid is not None or state.election_relay:
+            state.election_round += 1
+        self.reset(state)
+
+    @staticmethod
+    def reset(state):
+        state.election_tid = None
+        state.election_ntid = None
+        state.election_relay = False
+        state.election_progress = False
+
+    def handle(self, state, message):
+        out = []
+        if state.leader_id != -1:
+            out.append(Log('Ignoring ELECTION message as leader exists', DEBUG))
+            out.append(Reply(201))
+            return out
+        if message.election_round < state.election_round:
+            # a node which missed the last rounds, e.g. restarted, is starting an election - we start ours instead,
+            # our round pulls it in once it gets around to it
+            if message.kind == ElectionPhaseRequest.FIRST and state.election_tid is None and not state.election_relay:
+                out.append(Log(f'ELECTION message of the old round {message.election_round}, starting the round '
+                               f'{state.election_round}'))
+                state.election_progress = True
+                state.election_tid = state.id
+                out.append(Send(ElectionPhaseRequest(state.id, state.election_round, ElectionPhaseRequest.FIRST,
+                                                     state.id)))
+            else:
+                out.append(Log(f'Dropping ELECTION message of the old round {message.election_round}', DEBUG))
+            return out
+        state.election_progress = True
+        if message.election_round > state.election_round:
+            state.election_round = message.election_round
+            self.reset(state)
+
+        if message.kind == ElectionPhaseRequest.ELECTED:
+            if message.value == state.id:
+                out.append(Log('Highest ID came around the ring, announcing as leader'))
+                out.extend(announce_leader(state))
+            # the node with the highest ID went down meanwhile, the election starts again once it stops moving
+            elif sender_this_node(state, message):
+                out.append(Log(f'Node {message.value} elected as leader is gone, dropping', WARNING))
+            else:
+                out.append(forward(state, message))
+            return out
+        if state.election_relay:
+            out.append(Log('Relaying ELECTION message', DEBUG))
+            out.append(forward(state, message))
+            return out
+        # the election reached us before our timer fired, we take part from now on
+        if state.election_tid is None:
+            state.election_tid = state.id
+            out.append(Send(ElectionPhaseRequest(state.id, state.election_round, ElectionPhaseRequest.FIRST,
+                                                 state.id)))
+
+        if message.kind == ElectionPhaseRequest.FIRST:
+            if state.election_ntid is not None:
+                out.append(Log('Unexpected FIRST ELECTION message, dropping', WARNING))
+            # went around the whole ring, we are the only active node left
+            elif message.value == state.election_tid:
+                out.append(Log(f'Only active node left, {message.value} has the highest ID'))
+                if message.value == state.id:
+                    out.extend(announce_leader(state))
+                else:
+                    out.append(Send(ElectionPhaseRequest(state.id, state.election_round,
+                                                         ElectionPhaseRequest.ELECTED, message.value)))
+            else:
+                state.election_ntid = message.value
+                out.append(Send(ElectionPhaseRequest(state.id, state.election_round, ElectionPhaseRequest.SECOND,
+                                                     message.value)))
+        elif state.election_ntid is None:
+            out.append(Log('Unexpected SECOND ELECTION message, dropping', WARNING))
+        else:
+            ntid, state.election_ntid = state.election_ntid, None
+            if ntid > max(state.election_tid, message.value):
+                out.append(Log(f'Staying active for {ntid}', DEBUG))
+                state.election_tid = ntid
+                out.append(Send(ElectionPhaseRequest(state.id, state.election_round, ElectionPhaseRequest.FIRST,
+                                                     ntid)))
+            else:
+                out.append(Log('Relaying the ELECTION messages from now on', DEBUG))
+                state.election_relay = True
+        return out
+
+
+# algorithm name -> algorithm, the names are listed in utils.ELECTIONS
+ELECTION_ALGORITHMS = {'chang_roberts': ChangRoberts(), 'peterson': Peterson()}
+ELECTIONS_BY_MESSAGE_TYPE = {algorithm.message_type: algorithm for algorithm in ELECTION_ALGORITHMS.values()}
+
+
+def announce_leader(state):
+    """
+    :return: actions making us the leader and telling the ring
+    """
+    state.round_trip_made = True
+    state.leader_id = state.id
+    # stop sending election messages
+    return [Log('-- cancelling election timer'), CancelTimer('election_init'),
+            Send(traced(state, BaseRequest(state.id, MessageType.LEADER_ELECTED)))]
+
+
+# --------------------------------------------------------------------------------------------------
+# Timer jobs
+# --------------------------------------------------------------------------------------------------
+
+
+def send_leader_down_message(state):
+    if state.leader_id != -1:
+        return
+    yield Log(f'Sending LEADER_DOWN to the right neighbour')
+    yield Send(BaseRequest(state.id, MessageType.LEADER_DOWN))
+
+    # continue the timer, we can cancel it later
+    yield StartTimer('leader_down', purge=True)
+
+
+def send_election_message(state):
+    if state.leader_id == -1:
+        state.metrics.election_started()
+    try:
+        # timeout when initializing the network
+        if state.election_attempts >= MAX_ELECTION_ATTEMPTS:
+            yield Log('Could not contact the right neighbour for too long, assuming dead and moving onto next one',
+                      WARNING)
+            yield ShiftNeighbour()
+            yield Log(f'New right neighbour: {state.get_right_neighbour_address()}')
+
+        message = ELECTION_ALGORITHMS[state.election].start(state)
+        if message is not None:
+            yield Log(f'Sending ELECTION to the right neighbour')
+            reply = yield Request(message)
+            yield Log(f'OK sending ELECTION to the right neighbour')
+        # the election is moving on without us sending anything, we only check the right neighbour is up
+        else:
+            yield Log('Pinging right neighbour while the election is in progress', DEBUG)
+            reply = yield Request(BaseRequest(state.id, MessageType.PING))
+        register_right_neighbour(state, reply)
+
+        # Now that we know our right neighbour is alive, we can start pinging him
+        started = not (yield StartTimerIfMissing('ping', state.failure_detector.probe_interval))
+        if started:
+            yield Log('-- starting ping in send_election_message')
+        state.election_attempts = 0
+
+        # if we have not received the LEADER ELECTED message, we don't know if the ring is complete
+        # so we continue sending the message - the same while there is no leader after the first election, a message
+        # lost with another node would stop the election for good
+        if not state.round_trip_made or state.leader_id == -1:
+            yield StartTimer('election_init', purge=True)
+            yield Log('-- round trip not made yet, continue sending ELECTION messages')
+
+    except Exception:
+        ELECTION_ALGORITHMS[state.election].failed(state)
+        yield Log(f'FAIL sending ELECTION to the right neighbour', WARNING)
+        yield StartTimer('election_init', purge=True)
+        yield Log('-- continue sending ELECTION messages')
+        state.election_attempts += 1
+
+
+def ping_right_neighbour(state):
+    detector = state.failure_detector
+    try:
+        yield Log(f'Pinging right neighbour {state.right_neighbour_ip}', DEBUG)
+        detector.probe_sent()
+        reply = yield Request(BaseRequest(state.id, MessageType.PING), timeout=detector.timeout())
+        detector.heartbeat()
+        register_right_neighbour(state, reply)
+        yield Log(f'Right neighbour responded to ping', DEBUG)
+
+        # reset the timer
+        yield StartTimer('ping', purge=True, timeout=detector.probe_interval)
+        yield Log('-- starting ping in ping_right_neighbour', DEBUG)
+        return
+    except Exception:
+        pass
+
+    # a single failed ping is not enough if the neighbour has been replying regularly so far
+    if not detector.suspect():
+        yield Log(f'Ping failed, suspicion {detector.suspicion():.2f} below threshold, pinging again', WARNING)
+        yield StartTimer('ping', purge=True, timeout=detector.probe_interval)
+        return
+
+    # before tearing the ring apart, check whether the neighbour is alive and only we cannot reach it
+    if detector.cleared_in_row < MAX_CLEARED_SUSPICIONS and (yield from neighbour_heard_of(state)):
+        detector.cleared()
+        yield Log('Could not ping the neighbour, but the node after it still hears from it, pinging again', WARNING)
+        yield StartTimer('ping', purge=True, timeout=detector.probe_interval)
+        return
+
+    detector.dead()
+    if state.leader_id == state.id:
+        state.metrics.failure_detected()
+    yield CancelTimer('ping')
+    yield Log(f'Could not ping the neighbour, assuming dead, attempting to recover', WARNING)
+    yield from recover_neighbour_dead(state)
+
+
+def neighbour_heard_of(state):
+    """
+    Indirect ping - asks the node after the right neighbour when it last heard from it, the neighbour pings that node
+    regularly if it is alive
+    :return: True if the neighbour was heard from recently
+    """
+    _next = state.peek_next_neighbour()
+    if _next is None:
+        return False
+
+    try:
+        reply = yield Request(ProbeRequest(state.id, state.right_neighbour_id),
+                              this_address=_next == (state.ip, state.port), address=_next)
+    except Exception:
+        yield Log('Could not contact the node after the neighbour to check on it', WARNING)
+        return False
+
+    last_heard = reply.get('last_heard')
+    # an alive neighbour pings the node every probe interval, give or take the delays
+    return last_heard is not None and last_heard < HEARD_OF_INTERVALS * state.failure_detector.probe_interval
+
+
+def recover_neighbour_dead(state):
+    leader_dead = state.right_neighbour_id == state.leader_id
+    # the ring members we know of come first, which jumps over the addresses which were not part of the ring, once
+    # they are used up we go address by address
+    successors = state.ring_successors()
+    neighbour_reachable = False
+    while not neighbour_reachable:
+        valid = yield ShiftNeighbour(successors.pop(0) if successors else None)
+        if not valid:
+            yield Log('Only one node left in the ring, setting as leader and coloring GREEN')
+            state.leader_id = state.id
+            state.color = Color.GREEN
+            state.metrics.ring_colored()
+            return
+
+        # try to contact the next in ring
+        yield Log(f'Setting right neighbour to {state.get_right_neighbour_address()}, contacting')
+        try:
+            state.failure_detector.probe_sent()
+            reply = yield Request(BaseRequest(state.id, MessageType.PING))
+            state.failure_detector.heartbeat()
+            register_right_neighbour(state, reply)
+            neighbour_reachable = True
+            yield StartTimer('ping', timeout=state.failure_detector.probe_interval)
+            yield Log('-- starting pinging after neighbour reached')
+        except Exception:
+            yield Log(f'Could not contact {state.right_neighbour_ip}', WARNING)
+
+    if leader_dead:
+        state.leader_id = -1
+        # if the leader is down, we send a message to inform others that the leader is down - this message
+        # should be able to make it's way around the ring setting everyone's leader IDs to -1, allowing for the election
+        # process to take place
+        yield StartTimer('leader_down')
+        yield Log('-- started leader down timer')
+    else:
+        # if the node is not the leader, we just send a message announcing it around and the leader catches it
+        # he will then collect IDs again and color the ring
+        try:
+            if state.leader_id == state.id:
+                # If we are the leader, we just send it to ourselves
+                yield Log('Sending NODE_DOWN message to SELF')
+                yield Request(NodeDownRequest(state.id, state.right_neighbour_id), this_address=True)
+            else:
+                yield from send_node_down(state)
+        except Exception:
+            yield Log('Could not send the NODE_DOWN message', WARNING)
+
+
+def send_node_down(state):
+    """
+    Sends NODE_DOWN straight to the leader, if it cannot be reached then to the farthest finger before it, the message
+    goes on around the ring from there. The right neighbour is the last resort
+    """
+    for address in state.leader_route():
+        try:
+            yield Log(f'Sending NODE_DOWN message to {address[0]}:{address[1]}')
+            yield Request(NodeDownRequest(state.id, state.right_neighbour_id), address=address)
+            return
+        except Exception:
+            yield Log(f'Could not send the NODE_DOWN message to {address[0]}:{address[1]}', WARNING)
+
+    yield Log('Sending NODE_DOWN message to the right neighbour')
+    yield Request(NodeDownRequest(state.id, state.right_neighbour_id))
+
+
+def join_ring(state):
+    """
+    Asks the first node up after us to splice us into the ring - the JOIN goes around from it to the node we belong
+    after, which sends it back to us with our right neighbour
+    """
+    if state.leader_id != -1:
+        return
+    for address in state.join_candidates():
+        try:
+            reply = yield Request(JoinRequest(state.id, (state.ip, state.port)), address=address)
+        except Exception:
+            continue
+
+        if reply.get('leader_id', -1) == -1:
+            yield Log('There is no ring to join yet, waiting for the election')
+            return
+        yield Log(f'JOIN accepted by {address[0]}:{address[1]}')
+        # in case the JOIN gets lost on its way
+        yield StartTimer('join', purge=True, timeout=JOIN_RETRY_SEC)
+        return
+    yield Log('No other node is up, waiting for the election')
+
+
+def notify_join(state):
+    """
+    Passes the JOIN which spliced us in on to the leader - straight to it if we know its address, otherwise around the
+    ring
+    """
+    notice, state.join_notice = state.join_notice, None
+    if notice is None:
+        return
+    if notice.leader_address is not None:
+        try:
+            yield Log('Sending JOIN to the leader')
+            yield Request(notice, address=tuple(notice.leader_address))
+            return
+        except Exception:
+            yield Log('Could not send the JOIN message to the leader', WARNING)
+    yield Log('Sending JOIN around the ring to the leader')
+    yield forward(state, notice)
+
+
+# timer key -> job run when the timer fires
+TIMER_JOBS = {
+    'election_init': send_election_message,
+    'ping': ping_right_neighbour,
+    'leader_down': send_leader_down_message,
+    'join': join_ring,
+    'join_notify': notify_join
+}
+
+
+def run_job(job, perform):
+    """
+    Runs a timer job to completion
+    :param job: generator returned by one of the TIMER_JOBS
+    :param perform: function carrying out an action and returning its result
+    """
+    result, error = None, None
+    while True:
+        try:
+            action = job.throw(error) if error is not None else job.send(result)
+        except StopIteration:
+            return
+        result, error = None, None
+        try:
+            result = perform(action)
+        except Exception as e:
+            error = e
+
+
+# --------------------------------------------------------------------------------------------------
+# Utility functions
+# --------------------------------------------------------------------------------------------------
+
+
+def forward(state, message):
+    message.sender_id = state.id
+    if message.trace is not None and not neighbour_keeps_trace(state):
+        message.trace = None
+    state.tracer.forwarded(message)
+    return Send(message)
+
+
+def traced(state, message):
+    """
+    Starts the trace of a round trip we are sending, if it is sampled and the right neighbour keeps it
+    :return: the message
+    """
+    if neighbour_keeps_trace(state):
+        state.tracer.start(state.id, message)
+    return message
+
+
+def neighbour_keeps_trace(state):
+    # the fallback codec carries the hop records as one more attribute, which any node passes on, the binary codec
+    # only to the nodes which advertise it
+    return state.right_neighbour_trace or state.right_neighbour_codec != BinaryCodec.name
+
+
+def neighbour_keeps_sequence(state):
+    # the fallback codec carries the sequence as one more attribute, which the older nodes ignore, the binary codec
+    # only to the nodes which advertise it
+    return state.right_neighbour_sequence or state.right_neighbour_codec != BinaryCodec.name
+
+
+def report_trace(message):
+    """
+    :return: actions logging the per hop latencies of a traced message which came back to us
+    """
+    if message.trace is None:
+        return []
+    return [Log(Tracer.profile(message))]
+
+
+def sender_this_node(state, message):
+    return message.original_id == state.id
+
+
+def remaining_node_ids(state, message):
+    """
+    Leaves out the nodes which went down from the leader's IDs - those between the sender of NODE_DOWN and its new
+    right neighbour in the ring order
+    :return: list of the remaining IDs, None if it cannot be told which nodes are down
+    """
+    # the older nodes do not send the neighbour ID
+    neighbour_id = getattr(message, 'neighbour_id', None)
+    node_ids = state.node_ids
+    if neighbour_id is None or not node_ids or message.original_id not in node_ids or neighbour_id not in node_ids:
+        return None
+
+    start = node_ids.index(message.original_id)
+    end = node_ids.index(neighbour_id)
+    # the IDs start with the leader, so the sender can only wrap around to it
+    if end == 0:
+        end = len(node_ids)
+    if end <= start:
+        return None
+    return node_ids[:start + 1] + node_ids[end:]
+
+
+def joins_after(state, address):
+    """
+    :return: True if the node at the (ip, port) belongs between us and the right neighbour
+    """
+    this, neighbour = (state.ip, state.port), (state.right_neighbour_ip, state.right_neighbour_port)
+    return tuple(address) == neighbour or state.address_between(tuple(address), this, neighbour)
+
+
+def leader_address(state):
+    """
+    :return: (ip, port) of the leader, None if we do not know it
+    """
+    if state.leader_id == state.id:
+        return state.ip, state.port
+    route = state.leader_route()
+    return route[0] if route else None
+
+
+def recolor_joined(state, message):
+    """
+    Adds the spliced node to the IDs after its predecessor and sends the colors which changed, the same way as after
+    a node goes down. If it cannot be told where the node is or an older node is in the ring, the IDs are collected
+    again
+    :return: list of actions
+    """
+    node_ids = state.node_ids
+    if not state.delta_recoloring or state.delta_pending or state.node_addresses is None or not node_ids \
+            or message.predecessor_id not in node_ids or message.original_id in node_ids:
+        return [Log('Received JOIN message, starting new ID COLLECTION'),
+                Send(traced(state, CollectRequest(state.id, (state.ip, state.port))))]
+
+    # the ID the node had before the restart goes, if it was still in the ring
+    addresses = state.node_addresses or {}
+    ids = [node_id for node_id in node_ids
+           if node_id != message.replaced_id and addresses.get(node_id) != tuple(message.address)]
+    ids.insert(ids.index(message.predecessor_id) + 1, message.original_id)
+    coloring = ColorRequest(state.id, ids, node_ids, strategy=state.coloring)
+    state.node_ids = ids
+    if state.node_addresses is not None:
+        remaining = set(ids)
+        state.node_addresses = {node_id: address for node_id, address in state.node_addresses.items()
+                                if node_id in remaining}
+        state.node_addresses[message.original_id] = tuple(message.address)
+        state.set_ring(ids, [state.node_addresses[node_id] for node_id in ids])
+    state.delta_pending = True
+    return [Log(f'Received JOIN message, sending COLORING of {len(coloring.node_ids)} changed nodes'),
+            Send(traced(state, coloring))]
+
+
+def register_right_neighbour(state, reply):
+    """
+    Stores the ID, the preferred wire codec and whether it accepts batches, traces and sequence numbers of the right
+    neighbour from its reply
+    :param reply: reply body to a message sent to the right neighbour
+    """
+    state.right_neighbour_id = reply['id']
+    state.right_neighbour_codec = negotiate_codec(reply.get('codecs'))
+    state.right_neighbour_batch = MessageType.BATCH.value in reply.get('accepts', [])
+    state.right_neighbour_trace = TRACE in reply.get('accepts', [])
+    state.right_neighbour_sequence = SEQUENCE in reply.get('accepts', [])
+
+
+def reply_body(state, extra=None):
+    # every reply carries our ID, the codecs we can decode and the optional message types we accept
+    body = {'id': state.id, 'codecs': SUPPORTED_CODECS, 'accepts': [MessageType.BATCH.value, TRACE, SEQUENCE]}
+    if extra is not None:
+        body.update(extra)
+    return body
@@ -0,0 +1,400 @@
+"""
+In-process ring simulator - runs many nodes of the protocol in one process over an in-memory transport with a
+virtual clock, so a 1000 node ring with the real 30s timers takes seconds instead of hours
+
+Every message is passed through the binary codec, like on the wire, which also gives the byte counts. Reports the
+time to elect the leader, time to color the whole ring and the number of messages, for each ring size and after
+each scripted kill and restart.
+
+Run with: python simulator.py --sizes 10 100 1000 --kill 3@200 --kill leader@400 [--restart 3@600] [--json results.json]
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+from collections import Counter
+
+from utils import *
+from protocol import *
+
+TIMEOUT_SEC = 30
+LATENCY_SEC = 0.001
+START_JITTER_SEC = 1.0
+
+
+class ClockEvent:
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+    """
+    Event queue ordered by virtual time, provides the call_later() of an event loop so LoopTimerManager can use it
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        event = ClockEvent(callback, args)
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), event))
+        return event
+
+    def run(self, until, stop=None):
+        """
+        Runs the events in order until the virtual time or until stop() returns True
+        :return: True if stopped by stop()
+        """
+        while self.events and self.events[0][0] <= until:
+            when, _, event = heapq.heappop(self.events)
+            if event.cancelled:
+                continue
+            self.now = when
+            event.callback(*event.args)
+            if stop is not None and stop():
+                return True
+        self.now = until
+        return False
+
+
+class SimNode:
+    def __init__(self, simulation, _id, port):
+        self.simulation = simulation
+        self.network_info = NetworkInfo(_id, 'localhost', None, port, 'port', simulation.members)
+        self.network_info.failure_detector = PhiAccrualDetector(clock=simulation.clock.time)
+        self.network_info.coalescer = Coalescer(clock=simulation.clock.time)
+        self.network_info.seen = SeenCache(clock=simulation.clock.time)
+        self.network_info.metrics = Metrics(clock=simulation.clock.time)
+        self.network_info.tracer = Tracer(simulation.trace_sample, clock=simulation.clock.time)
+        self.network_info.delta_recoloring = simulation.delta_recoloring
+        self.network_info.coloring = COLORING_STRATEGIES[simulation.coloring]()
+        self.network_info.election = simulation.election
+        self.timer_manager = LoopTimerManager(simulation.timeout, simulation.clock)
+        self.alive = True
+
+    def start(self):
+        self.timer_manager.add_timer_and_run('election_init', self.timer_callback('election_init'))
+        self.timer_manager.add_timer_and_run('join', self.timer_callback('join'), timeout=JOIN_DELAY_SEC)
+
+    def receive(self, message):
+        _, actions = handle_message(self.network_info, message)
+        extra = None
+        for action in actions:
+            if isinstance(action, Reply):
+                extra = action.extra
+            else:
+                self.perform(action)
+        self.simulation.observe(self, message)
+        return reply_body(self.network_info, extra)
+
+    def perform(self, action):
+        if isinstance(action, Send):
+            return self.simulation.send(self, action.message, action.this_address)
+        elif isinstance(action, StartTimer):
+            return self.timer_manager.add_timer_and_run(action.key, self.timer_callback(action.key), action.purge,
+                                                        action.timeout)
+        elif isinstance(action, StartTimerIfMissing):
+            return self.timer_manager.add_run_if_not_existing(action.key, self.timer_callback(action.key),
+                                                              action.timeout)
+        elif isinstance(action, CancelTimer):
+            return self.timer_manager.cancel_timer(action.key)
+        elif isinstance(action, ShiftNeighbour):
+            return self.network_info.next_neighbour_shift(action.address)
+        elif isinstance(action, Log):
+            return self.simulation.log(self, action.text, action.level)
+
+    def run_job(self, job, result=None, error=None):
+        """
+        Runs a timer job, a Request suspends the job for the round trip time
+        """
+        if not self.alive:
+            return
+        while True:
+            try:
+                action = job.throw(error) if error is not None else job.send(result)
+            except StopIteration:
+                return
+            result, error = None, None
+
+            if isinstance(action, Request):
+                try:
+                    result = self.simulation.request(self, action.message, action.this_address, action.address)
+                except ConnectionError as e:
+                    error = e
+                self.simulation.clock.call_later(2 * self.simulation.latency, self.run_job, job, result, error)
+                return
+            result = self.perform(action)
+
+    def timer_callback(self, key):
+        return lambda: self.run_job(TIMER_JOBS[key](self.network_info))
+
+
+class Simulation:
+    def __init__(self, node_count, latency=LATENCY_SEC, timeout=TIMEOUT_SEC, seed=None, verbose=False,
+                 delta_recoloring=True, log_level=INFO, trace_sample=0.0, coloring='fraction', election='chang_roberts',
+                 id_order='random'):
+        """
+        :param id_order: 'random', or 'sorted' / 'reverse' for the IDs increasing / decreasing in the direction the
+        messages go around the ring
+        """
+        self.clock = VirtualClock()
+        self.latency = latency
+        self.timeout = timeout
+        self.verbose = verbose
+        self.log_level = log_level
+        self.trace_sample = trace_sample
+        self.delta_recoloring = delta_recoloring
+        self.coloring = coloring
+        self.election = election
+        self.random = random.Random(seed)
+
+        self.nodes = {}
+        self.node_count = node_count
+        self.alive_count = node_count
+        # one member list shared by all the nodes
+        self.members = Membership.from_scheme('port', 'localhost', node_count)
+        ids = self.random.sample(range(0, 2_000_000_000), node_count)
+        if id_order != 'random':
+            ids.sort(reverse=id_order == 'reverse')
+        for i, _id in enumerate(ids):
+            node = SimNode(self, _id, 5001 + i)
+            self.nodes[('localhost', node.network_info.port)] = node
+            self.clock.call_later(self.random.uniform(0, START_JITTER_SEC), node.start)
+
+        self.messages = Counter()
+        self.bytes = 0
+        self.bytes_by_type = Counter()
+        self.lost = 0
+        # (time, leader ID) of every finished election
+        self.elections = []
+        # (time, number of colored nodes) of every finished coloring
+        self.colorings = []
+
+    # ----------------------------------------------------------------------------------------------
+    # Transport
+    # ----------------------------------------------------------------------------------------------
+
+    def request(self, sender, message, this_address=False, address=None):
+        """
+        Delivers the message right away and returns the reply body, raises ConnectionError if the target is dead
+        """
+        target = self.nodes.get(address) if address is not None and not this_address else \
+            self.target(sender, this_address)
+        if target is None or not target.alive:
+            raise ConnectionError('Node is down')
+        return target.receive(self.transfer(sender, message))
+
+    def send(self, sender, message, this_address=False):
+        target = self.target(sender, this_address)
+        copy = self.transfer(sender, message)
+        self.clock.call_later(self.latency, self.deliver, target, copy)
+        return True
+
+    def deliver(self, target, message):
+        if target is None or not target.alive:
+            self.lost += 1
+            return
+        target.receive(message)
+
+    def target(self, sender, this_address):
+        info = sender.network_info
+        if this_address:
+            return sender
+        return self.nodes.get((info.right_neighbour_ip, info.right_neighbour_port))
+
+    def transfer(self, sender, message):
+        # the receiver gets its own copy, as if it came over the wire
+        data, content_type = encode_message(message, BinaryCodec.name)
+        self.messages[message.message_type.name] += 1
+        self.bytes += len(data)
+        self.bytes_by_type[message.message_type.name] += len(data)
+        return decode_message(data, content_type)
+
+    # ----------------------------------------------------------------------------------------------
+    # Scenario
+    # ----------------------------------------------------------------------------------------------
+
+    def observe(self, node, message):
+        info = node.network_info
+        if message.message_type == MessageType.NODE_DOWN and info.leader_id == info.id and not info.delta_pending \
+                and info.node_ids is not None and len(info.node_ids) == self.alive_count:
+            # the delta recoloring had no colors to change, the ring is colored right away
+            self.colorings.append((self.clock.now, len(info.node_ids)))
+        if message.original_id != info.id:
+            return
+        if message.message_type == MessageType.LEADER_ELECTED:
+            self.elections.append((self.clock.now, info.id))
+        elif message.message_type == MessageType.COLORING:
+            # a delta only carries the changed nodes, the leader knows how many there are in total
+            colored = len(info.node_ids) if message.delta else len(message.node_ids)
+            self.colorings.append((self.clock.now, colored))
+
+    def kill(self, target):
+        """
+        :param target: 1-based node index or 'leader'
+        :return: killed node or None
+        """
+        alive = [node for node in self.nodes.values() if node.alive]
+        if target == 'leader':
+            candidates = [node for node in alive if node.network_info.leader_id == node.network_info.id]
+        else:
+            candidates = [node for node in alive if node.network_info.port == 5000 + int(target)]
+        if not candidates:
+            return None
+        candidates[0].alive = False
+        self.alive_count -= 1
+        self.log(candidates[0], 'KILLED')
+        return candidates[0]
+
+    def restart(self, index):
+        """
+        Starts a new node with a new ID on the address of the node, which is killed first if it is still running
+        :param index: 1-based node index
+        :return: started node or None
+        """
+        address = ('localhost', 5000 + index)
+        old = self.nodes.get(address)
+        if old is None:
+            return None
+        if old.alive:
+            old.alive = False
+        else:
+            self.alive_count += 1
+        node = SimNode(self, self.random.randrange(0, 2_000_000_000), address[1])
+        self.nodes[address] = node
+        self.log(node, f'RESTARTED in place of {old.network_info.id}')
+        node.start()
+        return node
+
+    def ring_colored_since(self, since):
+        """
+        :return: time of the first coloring of all alive nodes finished after the time, or None
+        """
+        for when, colored in self.colorings:
+            if when >= since and colored == self.alive_count:
+                return when
+        return None
+
+    def log(self, node, text, level=INFO):
+        if self.verbose and level >= self.log_level:
+            print(f'[{self.clock.now:10.3f}][{node.network_info.id}]\t{text}')
+
+
+def run_scenario(node_count, kills, duration, latency=LATENCY_SEC, seed=None, verbose=False, delta_recoloring=True,
+                 log_level=INFO, trace_sample=0.0, restarts=(), coloring='fraction', election='chang_roberts'):
+    """
+    Runs one ring until it is colored after the last kill or restart (or the duration runs out)
+    :param kills: list of (time, target) - target is a 1-based node index or 'leader'
+    :param restarts: list of (time, 1-based node index) of the nodes started again, with a new ID
+    :param delta_recoloring: recolor only the changed nodes after a node goes down
+    :param log_level: lowest level printed with verbose
+    :param trace_sample: fraction of the round trips traced hop by hop, the traces are printed with verbose
+    :param coloring: name of the coloring strategy
+    :param election: name of the election algorithm
+    :return: dict with the results, times are in virtual seconds
+    """
+    simulation = Simulation(node_count, latency, seed=seed, verbose=verbose, delta_recoloring=delta_recoloring,
+                            log_level=log_level, trace_sample=trace_sample, coloring=coloring, election=election)
+    result = {'nodes': node_count, 'kills': [], 'restarts': []}
+
+    events = [(when, 'kill', target) for when, target in kills] + \
+        [(when, 'restart', index) for when, index in restarts]
+    last_time = 0.0
+    messages_before, bytes_before = Counter(), Counter()
+    for event_time, event, target in sorted(events, key=lambda event: event[0]):
+        simulation.clock.run(event_time)
+        if event == 'kill':
+            node = simulation.kill(target)
+        else:
+            node = simulation.restart(int(target))
+        if node is not None:
+            result[event + 's'].append({'time': event_time, 'target': target, 'node': node.network_info.id})
+        last_time = event_time
+        messages_before, bytes_before = simulation.messages.copy(), simulation.bytes_by_type.copy()
+
+    stopped = simulation.clock.run(duration, lambda: simulation.ring_colored_since(last_time) is not None)
+
+    detectors = [node.network_info.failure_detector.stats() for node in simulation.nodes.values() if node.alive]
+    detections = sum(stats['detections'] for stats in detectors)
+    first_coloring = next((when for when, colored in simulation.colorings if colored == node_count), None)
+    result.update({
+        'time_to_leader': simulation.elections[0][0] if simulation.elections else None,
+        'time_to_coloring': first_coloring,
+        'time_to_recoloring': simulation.ring_colored_since(last_time) - last_time if stopped and events else None,
+        'messages': sum(simulation.messages.values()),
+        'messages_by_type': dict(simulation.messages),
+        'bytes': simulation.bytes,
+        # everything sent after the last kill or restart, by message type
+        'messages_since_kill': dict(simulation.messages - messages_before),
+        'bytes_since_kill': dict(simulation.bytes_by_type - bytes_before),
+        'lost': simulation.lost,
+        'suppressed': sum(node.network_info.coalescer.stats()['suppressed'] for node in simulation.nodes.values()),
+        'seen_again': sum(node.network_info.seen.stats()['hits'] for node in simulation.nodes.values()),
+        'suspicions': sum(stats['suspicions'] for stats in detectors),
+        'false_suspicions': sum(stats['false_suspicions'] for stats in detectors),
+        'detection_latency_avg': sum(stats['detection_latency_avg'] * stats['detections'] for stats in detectors) /
+        detections if detections else None,
+        'virtual_time': simulation.clock.now,
+        'completed': stopped
+    })
+    return result
+
+
+def parse_kill(value):
+    # node@time, e.g. 3@200 or leader@400
+    target, _, kill_time = value.partition('@')
+    return float(kill_time), target
+
+
+def format_time(value):
+    return f'{value:.3f}' if value is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--kill', action='append', type=parse_kill, default=[],
+                        help='node to kill as index@time or leader@time, can be repeated')
+    parser.add_argument('--restart', action='append', type=parse_kill, default=[],
+                        help='node to start again (with a new ID) as index@time, can be repeated')
+    parser.add_argument('--duration', type=float, default=3600, help='virtual seconds to run at most')
+    parser.add_argument('--latency', type=float, default=LATENCY_SEC)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--log_level', default='INFO', choices=list(LOG_LEVELS),
+                        help='lowest level printed with --verbose')
+    parser.add_argument('--trace_sample', type=float, default=0.0,
+                        help='fraction of the round trips traced hop by hop, printed with --verbose')
+    parser.add_argument('--coloring', default='fraction', choices=list(COLORING_STRATEGIES))
+    parser.add_argument('--election', default='chang_roberts', choices=ELECTIONS)
+    parser.add_argument('--json', help='write the results to the file')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"N":>6}{"leader s":>12}{"colored s":>12}{"recolored s":>13}{"messages":>11}{"bytes":>12}{"lost":>7}')
+    for size in args.sizes:
+        result = run_scenario(size, args.kill, args.duration, args.latency, args.seed, args.verbose,
+                              log_level=LOG_LEVELS[args.log_level], trace_sample=args.trace_sample,
+                              restarts=args.restart, coloring=args.coloring, election=args.election)
+        results.append(result)
+        print(f'{size:>6}{format_time(result["time_to_leader"]):>12}{format_time(result["time_to_coloring"]):>12}'
+              f'{format_time(result["time_to_recoloring"]):>13}{result["messages"]:>11}{result["bytes"]:>12}'
+              f'{result["lost"]:>7}')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
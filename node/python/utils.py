@@ -1,22 +1,280 @@
+import argparse
+import atexit
+import bisect
+import copy
+import heapq
+import itertools
+import json
 import math
+import os
+import queue
+import random
+import struct
+import sys
 import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime
 from enum import Enum
 
 GREEN_COLOR_FRACTION = 1 / 3
 IP_OFFSET = 100
+# port of every node in the ip mode address scheme
+SCHEME_PORT = 5000
+# node IDs are sent as unsigned 32 bit integers in the binary format, -1 means no leader
+MAX_NODE_ID = 0xFFFFFFFF
+# how often the right neighbour is pinged and how long we wait for the reply at least
+PROBE_INTERVAL_SEC = 5
+PROBE_TIMEOUT_SEC = 0.5
+# duplicate control messages forwarded within this time are dropped
+COALESCE_WINDOW_SEC = 1.0
+# most messages sent to the neighbour in one request
+MAX_BATCH_SIZE = 32
+# (origin ID, sequence) of the messages a node remembers to drop them when they come again, and for how long - longer
+# than a message takes around the ring
+SEEN_CACHE_SIZE = 4096
+SEEN_TTL_SEC = 120
+
+# upper bounds of the latency histogram buckets in seconds, from a local handler call to a full ring recovery
+LATENCY_BUCKETS_SEC = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+                       300)
+
+# advertised in the replies by the nodes which keep the hop records of traced messages
+TRACE = 'trace'
+# advertised in the replies by the nodes which read the sequence numbers of the messages
+SEQUENCE = 'sequence'
+
+# names of the leader election algorithms, implemented in protocol.py
+ELECTIONS = ['chang_roberts', 'peterson']
+
+# HTTP servers app.py can serve the node with - the Werkzeug development server or waitress with a fixed thread pool
+SERVERS = ['werkzeug', 'waitress']
+SERVER_THREADS = 8
+
+# log levels, the records below the configured one are dropped
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LOG_LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+LOG_LEVEL_NAMES = {level: name for name, level in LOG_LEVELS.items()}
+# text lines, or a JSON object per line with the structured fields of the record as keys
+LOG_FORMATS = ['text', 'json']
+
+# everything needed to create a node, node_id is random if not set
+# log_sample is the fraction of the DEBUG records which are written, log_format one of LOG_FORMATS, trace_sample the
+# fraction of the round trips started by this node which are traced hop by hop (0 turns tracing off)
+# members is the Membership from the seed list, None to use the address scheme
+# coloring is the name of the strategy the leader colors the ring with, one of COLORING_STRATEGIES, election the name
+# of the leader election algorithm, one of ELECTIONS - all the nodes of a ring have to use the same
+# server is the HTTP server of app.py, one of SERVERS, threads the number of its request threads
+NodeConfig = namedtuple('NodeConfig', ['ip', 'port', 'node_count', 'mode', 'timeout_sec', 'node_id', 'log_level',
+                                       'log_sample', 'trace_sample', 'members', 'coloring', 'election', 'server',
+                                       'threads', 'log_format'],
+                        defaults=[30, None, 'INFO', 1.0, 0.0, None, 'fraction', 'chang_roberts', 'werkzeug',
+                                  SERVER_THREADS, 'text'])
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', required=True, type=int)
+    parser.add_argument('--n_nodes', type=int, help='not needed with a member list')
+    parser.add_argument('--host', default='localhost', help='our host as it is in the member list')
+    parser.add_argument('--members', default=os.environ.get('RING_MEMBERS_FILE'), help='seed list file of the members')
+    parser.add_argument('--log_level', default=os.environ.get('LOG_LEVEL', 'INFO'), choices=list(LOG_LEVELS))
+    parser.add_argument('--log_sample', default=float(os.environ.get('LOG_SAMPLE', 1.0)), type=float)
+    parser.add_argument('--log_format', default=os.environ.get('LOG_FORMAT', 'text'), choices=LOG_FORMATS)
+    parser.add_argument('--trace_sample', default=float(os.environ.get('TRACE_SAMPLE', 0.0)), type=float)
+    parser.add_argument('--coloring', default=os.environ.get('COLORING', 'fraction'), choices=list(COLORING_STRATEGIES))
+    parser.add_argument('--election', default=os.environ.get('ELECTION', 'chang_roberts'), choices=ELECTIONS)
+    parser.add_argument('--server', default=os.environ.get('SERVER', 'werkzeug'), choices=SERVERS)
+    parser.add_argument('--threads', default=int(os.environ.get('SERVER_THREADS', SERVER_THREADS)), type=int,
+                        help='request threads of the waitress server')
+    return parser
+
+
+def load_config(mode, timeout_sec, args=None):
+    """
+    Reads the node configuration from the command line (port mode) or the environment (ip mode)
+    the logging can be set with LOG_LEVEL, LOG_SAMPLE and LOG_FORMAT, the tracing with TRACE_SAMPLE, the coloring
+    strategy with COLORING, the election algorithm with ELECTION and the HTTP server with SERVER and SERVER_THREADS in
+    both modes
+    the members of the ring are read from the seed list file (--members or RING_MEMBERS_FILE) or the RING_MEMBERS
+    variable, without them the addresses follow the scheme below
+    port runs on localhost, ip runs on network
+    port expects ports 5001, 5002, ...
+    ip expects addresses 10.0.1.101, 102, ...
+    :param args: already parsed command line arguments (dict), parsed here if None
+    :return: NodeConfig
+    """
+    if mode == 'port':
+        if args is None:
+            args = vars(config_parser().parse_args())
+        members = load_members(args.get('members'))
+        if members is None and args.get('n_nodes') is None:
+            raise ValueError('The number of nodes (--n_nodes) or the member list is needed')
+        return NodeConfig(args.get('host', 'localhost'), args['port'], args.get('n_nodes'), mode, timeout_sec,
+                          log_level=args.get('log_level', 'INFO'), log_sample=args.get('log_sample', 1.0),
+                          trace_sample=args.get('trace_sample', 0.0), members=members,
+                          coloring=args.get('coloring', 'fraction'), election=args.get('election', 'chang_roberts'),
+                          server=args.get('server', 'werkzeug'), threads=args.get('threads', SERVER_THREADS),
+                          log_format=args.get('log_format', 'text'))
+    elif mode == 'ip':
+        members = load_members()
+        if members is None and os.environ.get('NUM_NODES') is None:
+            raise ValueError('The number of nodes (NUM_NODES) or the member list is needed')
+        return NodeConfig(os.environ['IP_ADDRESS'], int(os.environ.get('PORT', SCHEME_PORT)),
+                          os.environ.get('NUM_NODES'), mode, timeout_sec, log_level=os.environ.get('LOG_LEVEL', 'INFO'),
+                          log_sample=float(os.environ.get('LOG_SAMPLE', 1.0)),
+                          trace_sample=float(os.environ.get('TRACE_SAMPLE', 0.0)), members=members,
+                          coloring=os.environ.get('COLORING', 'fraction'),
+                          election=os.environ.get('ELECTION', 'chang_roberts'),
+                          server=os.environ.get('SERVER', 'werkzeug'),
+                          threads=int(os.environ.get('SERVER_THREADS', SERVER_THREADS)),
+                          log_format=os.environ.get('LOG_FORMAT', 'text'))
+
+
+def load_members(path=None):
+    """
+    :param path: seed list file, RING_MEMBERS_FILE if None
+    :return: Membership from the seed list file or from the RING_MEMBERS variable, None if there is neither
+    """
+    path = path or os.environ.get('RING_MEMBERS_FILE')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            return Membership.parse(f.read())
+    if os.environ.get('RING_MEMBERS'):
+        return Membership.parse(os.environ['RING_MEMBERS'])
+    return None
+
+
+def create_node_id(config):
+    """
+    :return: node ID from the configuration, then from the member list, random if set in neither
+    """
+    if config.node_id is not None:
+        return config.node_id
+    if config.members is not None:
+        index = config.members.index((config.ip, config.port))
+        if index is not None and config.members.ids[index] is not None:
+            return config.members.ids[index]
+    return random.randint(0, 2_000_000_000)
+
+
+def create_coloring(config):
+    """
+    :return: coloring strategy of the configuration, the weighted one takes the weights from the member list
+    """
+    if config.coloring == 'weighted':
+        return WeightedColoring(config.members.weights() if config.members is not None else None)
+    return COLORING_STRATEGIES[config.coloring]()
+
+
+class Membership:
+    """
+    Addresses of all the nodes which can be part of the ring, in the ring order - the initial right neighbour of each
+    node is the next one. The index of every address, its successor and its URL are computed once, so the neighbour
+    lookups do not parse or format any strings. The members can be on any hosts and ports
+    """
+    def __init__(self, addresses, ids=None, capacities=None):
+        """
+        :param addresses: (host, port) of the members in the ring order
+        :param ids: node IDs fixed by the seed list, None for the ones not fixed
+        :param capacities: weights of the members for the weighted coloring, None for the ones not set
+        """
+        self.addresses = [(host, int(port)) for host, port in addresses]
+        self.ids = list(ids) if ids is not None else [None] * len(self.addresses)
+        self.capacities = list(capacities) if capacities is not None else [None] * len(self.addresses)
+        self.indexes = {address: index for index, address in enumerate(self.addresses)}
+        if len(self.indexes) != len(self.addresses):
+            raise ValueError('The member list contains an address more than once')
+        self.successors = [(index + 1) % len(self.addresses) for index in range(len(self.addresses))]
+        self.urls = [f'http://{host}:{port}/message' for host, port in self.addresses]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def index(self, address):
+        """
+        :return: position of the (host, port) in the ring order, None if it is not a member
+        """
+        return self.indexes.get(tuple(address))
+
+    def weights(self):
+        """
+        :return: dict node ID -> capacity of the members with both set
+        """
+        return {node_id: capacity for node_id, capacity in zip(self.ids, self.capacities)
+                if node_id is not None and capacity is not None}
+
+    @staticmethod
+    def from_scheme(mode, ip, node_count, port=SCHEME_PORT):
+        """
+        :param port: port of all the nodes in the ip mode
+        :return: Membership of the original address scheme - 10.0.1.101, 102, ... on the port in the ip mode, ports
+        5001, 5002, ... of the ip in the port mode
+        """
+        node_count = int(node_count)
+        if mode == 'ip':
+            prefix = ip.rsplit('.', 1)[0]
+            return Membership([(f'{prefix}.{IP_OFFSET + i}', port) for i in range(1, node_count + 1)])
+        return Membership([(ip, 5000 + i) for i in range(1, node_count + 1)])
+
+    @staticmethod
+    def parse(text):
+        """
+        :param text: members separated by new lines or commas, each as host:port optionally followed by the node ID
+        and its capacity separated by spaces, anything after # is a comment
+        """
+        addresses, ids, capacities = [], [], []
+        for line in text.splitlines():
+            for entry in line.split('#', 1)[0].split(','):
+                fields = entry.split()
+                if not fields:
+                    continue
+                host, _, port = fields[0].rpartition(':')
+                addresses.append((host, int(port)))
+                node_id = int(fields[1]) if len(fields) > 1 else None
+                if node_id is not None and not 0 <= node_id <= MAX_NODE_ID:
+                    raise ValueError(f'Node ID {node_id} of {fields[0]} is not between 0 and {MAX_NODE_ID}')
+                ids.append(node_id)
+                capacities.append(float(fields[2]) if len(fields) > 2 else None)
+        if not addresses:
+            raise ValueError('The member list is empty')
+        return Membership(addresses, ids, capacities)
 
 
 class NetworkInfo:
-    def __init__(self, _id, ip, node_count, port, mode):
+    def __init__(self, _id, ip, node_count, port, mode, members=None):
+        """
+        :param node_count: number of the nodes in the address scheme, not used with members
+        :param members: Membership of the ring, built from the address scheme if None
+        """
         # this node ID
         self.id = _id
-        self.node_count = int(node_count)
+        # all the nodes which can be part of the ring, in the ring order
+        self.members = members if members is not None else Membership.from_scheme(mode, ip, node_count, port)
+        self.node_count = len(self.members)
         # this node IP
         self.ip = ip
         self.leader_id = -1
         self.color = None
-        # only used by leader
+        # only used by leader - IDs in the ring order, as the ring was last colored
         self.node_ids = None
+        # only used by leader - decides which nodes are GREEN, can be replaced before the node starts
+        self.coloring = FractionColoring()
+        # only used by leader - a delta coloring is going around the ring
+        self.delta_pending = False
+        # recolor only the changed nodes after a node goes down, instead of collecting the IDs again
+        self.delta_recoloring = True
+        # only used by leader - node ID -> (ip, port), None if some node did not send its address
+        self.node_addresses = None
+        # (ID, (ip, port)) of the nodes in the ring order starting with the leader, learned from the full coloring
+        self.ring = None
+        # (ring distance, ID, (ip, port)) of the nodes at power of two distances from us and of the leader,
+        # nearest first
+        self.fingers = []
         # the port we run on
         self.port = port
 
@@ -24,130 +282,1491 @@ class NetworkInfo:
         self.round_trip_made = False
         # if the leader is down
         self.leader_down = False
+        # failed attempts to contact the right neighbour while forming the ring
+        self.election_attempts = 0
+        # leader election algorithm, one of ELECTIONS
+        self.election = 'chang_roberts'
+        # only used by the Peterson election - number of the election run, the messages of older runs are dropped
+        self.election_round = 0
+        # only used by the Peterson election - the ID we stand for while active, None if not taking part yet
+        self.election_tid = None
+        # only used by the Peterson election - the ID of the nearest active node before us in this phase, None until
+        # it comes
+        self.election_ntid = None
+        # only used by the Peterson election - we only pass the messages on
+        self.election_relay = False
+        # only used by the Peterson election - if an election message came since the election timer last fired
+        self.election_progress = False
         self.mode = mode
 
-        if mode == 'ip':
-            split_ip = ip.split('.')
-            self.ip_prefix = split_ip[0] + '.' + split_ip[1] + '.' + split_ip[2]
-            this = int(split_ip[3])
-
-            # One to the right if we are not the last node, otherwise the first node
-            if self.node_count == 2:
-                _next = 1 if this % 2 == 0 else 2
-            else:
-                _next = this + 1 if this - IP_OFFSET != self.node_count else IP_OFFSET + 1
-            self.right_neighbour_ip = f'{self.ip_prefix}.{_next}'
-            self.right_neighbour_port = port
-
-        elif mode == 'port':
-            _next = port + 1 if port - 5000 != self.node_count else 5000 + 1
-            self.right_neighbour_ip = f'{self.ip}'
-            self.right_neighbour_port = _next
+        # our position in the member list, the right neighbour is the next member (the first one after the last)
+        self.position = self.members.index((ip, port))
+        if self.position is None:
+            raise ValueError(f'{ip}:{port} is not in the member list')
+        self.this_url = self.members.urls[self.position]
+        # position of the right neighbour in the member list, None if it is not a member
+        self.right_neighbour_index = self.members.successors[self.position]
+        self.right_neighbour_ip, self.right_neighbour_port = self.members.addresses[self.right_neighbour_index]
 
         self.right_neighbour_id = -1
+        # wire codec the right neighbour understands, learned from its replies
+        self.right_neighbour_codec = DEFAULT_CODEC
+        # decides when the right neighbour is dead, can be replaced before the node starts
+        self.failure_detector = PhiAccrualDetector()
+        # drops the duplicate control messages we would forward
+        self.coalescer = Coalescer()
+        # drops the messages we have already handled
+        self.seen = SeenCache()
+        # if the right neighbour reads the sequence numbers, learned from its replies
+        self.right_neighbour_sequence = False
+        # if the right neighbour accepts several messages in one request, learned from its replies
+        self.right_neighbour_batch = False
+        # counters and latencies exported on /metrics
+        self.metrics = Metrics()
+        # decides which round trips are traced hop by hop, off unless the sample rate is set
+        self.tracer = Tracer()
+        # if the right neighbour keeps the hop records of traced messages, learned from its replies
+        self.right_neighbour_trace = False
+        # the JOIN which spliced us into the ring, to be passed on to the leader
+        self.join_notice = None
 
     def get_right_neighbour_address(self):
+        if self.right_neighbour_index is not None:
+            return self.members.urls[self.right_neighbour_index]
         return f'http://{self.right_neighbour_ip}:{self.right_neighbour_port}/message'
 
     def get_this_address(self):
-        return f'http://{self.ip}:{self.port}/message'
+        return self.this_url
+
+    def peek_next_neighbour(self):
+        """
+        :return: (ip, port) of the node after the right neighbour, None if there is no such node
+        """
+        if self.right_neighbour_index is None:
+            return None
+        return self.members.addresses[self.members.successors[self.right_neighbour_index]]
+
+    def next_neighbour_shift(self, address=None):
+        """
+        Moves onto the next node in the ring
+        :param address: (ip, port) to move onto, the next address after the right neighbour if None
+        :return: False if there is no other node to move onto
+        """
+        # we do not know what the new neighbour supports until it replies
+        self.right_neighbour_codec = DEFAULT_CODEC
+        self.right_neighbour_batch = False
+        self.right_neighbour_trace = False
+        self.failure_detector.reset()
+
+        _next = address if address is not None else self.peek_next_neighbour()
+        if _next is None:
+            return False
+        self.right_neighbour_ip, self.right_neighbour_port = _next
+        self.right_neighbour_index = self.members.index(_next)
+        return (self.right_neighbour_ip, self.right_neighbour_port) != (self.ip, self.port)
+
+    def set_ring(self, ids, addresses):
+        """
+        Remembers the members of the ring and builds the finger table
+        :param ids: IDs in the ring order starting with the leader
+        :param addresses: (ip, port) of the nodes, in the same order
+        """
+        if self.id not in ids:
+            return
+        self.ring = list(zip(ids, [tuple(address) for address in addresses]))
+        node_count = len(self.ring)
+        position = ids.index(self.id)
+
+        distances = set()
+        distance = 1
+        while distance < node_count:
+            distances.add(distance)
+            distance *= 2
+        if position != 0:
+            distances.add(node_count - position)
+        self.fingers = [(distance,) + self.ring[(position + distance) % node_count] for distance in sorted(distances)]
+
+    def address_between(self, address, start, end):
+        """
+        :return: True if the address comes after start and before end going around the member list, with start equal
+        to end any other address does. False if some of them is not a member
+        """
+        indexes = [self.members.index(member) for member in (address, start, end)]
+        if None in indexes:
+            return False
+        after_start = (indexes[0] - indexes[1]) % self.node_count
+        end_after_start = (indexes[2] - indexes[1]) % self.node_count
+        return after_start > 0 and (end_after_start == 0 or after_start < end_after_start)
+
+    def join_candidates(self):
+        """
+        :return: (ip, port) of all the other members, in the ring order starting after us
+        """
+        addresses = self.members.addresses
+        return addresses[self.position + 1:] + addresses[:self.position]
+
+    def ring_successors(self):
+        """
+        :return: (ip, port) of the ring members after the right neighbour up to us, in the ring order - empty if the
+        right neighbour is not a member we know of
+        """
+        if self.ring is None:
+            return []
+        addresses = [address for _, address in self.ring]
+        neighbour = (self.right_neighbour_ip, self.right_neighbour_port)
+        if neighbour not in addresses:
+            return []
+        start = addresses.index(neighbour)
+        successors = []
+        for i in range(1, len(addresses)):
+            address = addresses[(start + i) % len(addresses)]
+            if address == (self.ip, self.port):
+                break
+            successors.append(address)
+        return successors
+
+    def leader_route(self):
+        """
+        :return: (ip, port) of the fingers which do not go past the leader, the leader (farthest) first
+        """
+        leader = [distance for distance, node_id, _ in self.fingers if node_id == self.leader_id]
+        if not leader:
+            return []
+        return [address for distance, _, address in reversed(self.fingers) if distance <= leader[0]]
+
+
+class FailureDetector:
+    """
+    Decides whether the right neighbour is dead from the history of pings to it. This base class suspects the
+    neighbour after the first failed ping, like the fixed timeout did
+
+    Also remembers when we last heard from the nodes sending to us, so that others can ask us about our left neighbour
+    """
+    def __init__(self, probe_interval=PROBE_INTERVAL_SEC, probe_timeout=PROBE_TIMEOUT_SEC, window=100,
+                 clock=time.monotonic):
+        """
+        :param probe_interval: seconds between pings
+        :param probe_timeout: minimal time to wait for the ping reply, more is waited when the neighbour is slow
+        :param window: number of the latest pings kept
+        :param clock: time source in seconds
+        """
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.clock = clock
+        self.rtts = deque(maxlen=window)
+        self.intervals = deque(maxlen=window)
+        self.last_heartbeat = None
+        self.probe_start = None
+        self.heard = {}
+
+        self.suspicions = 0
+        self.false_suspicions = 0
+        # suspicions cleared since the last ping reply
+        self.cleared_in_row = 0
+        self.detections = 0
+        self.detection_latency_total = 0.0
+        self.detection_latency_last = 0.0
+
+    def probe_sent(self):
+        self.probe_start = self.clock()
+
+    def heartbeat(self):
+        """
+        The neighbour replied to the ping
+        """
+        now = self.clock()
+        if self.probe_start is not None:
+            self.rtts.append(now - self.probe_start)
+        if self.last_heartbeat is not None:
+            self.intervals.append(now - self.last_heartbeat)
+        self.last_heartbeat = now
+        self.cleared_in_row = 0
+
+    def suspicion(self):
+        return 0.0 if self.last_heartbeat is not None else math.inf
+
+    def suspect(self):
+        """
+        Called after a failed ping
+        :return: True if the neighbour should be checked and possibly declared dead, False to just ping again
+        """
+        self.suspicions += 1
+        return True
+
+    def cleared(self):
+        """
+        The neighbour was suspected, but turned out to be alive
+        """
+        self.false_suspicions += 1
+        self.cleared_in_row += 1
+
+    def dead(self):
+        """
+        The neighbour was declared dead
+        """
+        if self.last_heartbeat is not None:
+            self.detection_latency_last = self.clock() - self.last_heartbeat
+            self.detection_latency_total += self.detection_latency_last
+        self.detections += 1
+
+    def reset(self):
+        """
+        Forgets the history of the neighbour, called when we move onto another one
+        """
+        self.rtts.clear()
+        self.intervals.clear()
+        self.last_heartbeat = None
+        self.probe_start = None
+        self.cleared_in_row = 0
+
+    def timeout(self):
+        """
+        :return: how long to wait for the ping reply - grows when the neighbour replies slowly
+        """
+        if len(self.rtts) < 2:
+            return self.probe_timeout
+        mean, std = mean_std(self.rtts)
+        return min(max(self.probe_timeout, mean + 4 * std), self.probe_interval)
+
+    def heard_from(self, node_id):
+        self.heard[node_id] = self.clock()
+        # only the left neighbour(s) send to us, but do not let it grow if the ring keeps changing
+        if len(self.heard) > 16:
+            del self.heard[min(self.heard, key=self.heard.get)]
+
+    def last_heard(self, node_id):
+        """
+        :return: seconds since we received a message from the node, None if we never did
+        """
+        heard = self.heard.get(node_id)
+        return self.clock() - heard if heard is not None else None
+
+    def stats(self):
+        return {
+            'suspicion': self.suspicion(),
+            'timeout': self.timeout(),
+            'suspicions': self.suspicions,
+            'false_suspicions': self.false_suspicions,
+            'false_positive_rate': self.false_suspicions / self.suspicions if self.suspicions else 0.0,
+            'detections': self.detections,
+            'detection_latency_avg': self.detection_latency_total / self.detections if self.detections else 0.0,
+            'detection_latency_last': self.detection_latency_last
+        }
+
+
+class PhiAccrualDetector(FailureDetector):
+    """
+    Phi accrual failure detector (Hayashibara et al.) - the suspicion level phi grows with the time since the last ping
+    reply, relative to how regularly the replies came so far. A failed ping only leads to the neighbour being checked
+    once phi reaches the threshold, so one slow reply under load does not tear the ring apart
+    """
+    def __init__(self, threshold=8.0, min_std=0.5, **kwargs):
+        """
+        :param threshold: phi from which the neighbour is suspected, 8 means roughly 1e-8 chance of a mistake
+        :param min_std: lower bound of the standard deviation of the intervals, the pings are very regular otherwise
+        """
+        super(PhiAccrualDetector, self).__init__(**kwargs)
+        self.threshold = threshold
+        self.min_std = min_std
+
+    def suspicion(self):
+        if self.last_heartbeat is None or not self.intervals:
+            # no history to judge from
+            return math.inf
+
+        mean, std = mean_std(self.intervals)
+        std = max(std, self.min_std)
+        # logistic approximation of the normal CDF
+        y = (self.clock() - self.last_heartbeat - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def suspect(self):
+        if self.suspicion() < self.threshold:
+            return False
+        return super(PhiAccrualDetector, self).suspect()
+
+
+class Coalescer:
+    """
+    Drops the duplicate control messages a node is about to send - only the highest ELECTION survives and the same
+    LEADER_DOWN / NODE_DOWN is sent once within the window. The senders repeat these messages on their timers, which
+    are much longer than the window, so nothing which is still needed gets lost
+    """
+    def __init__(self, window=COALESCE_WINDOW_SEC, clock=time.monotonic):
+        """
+        :param window: seconds within which a repeated message counts as a duplicate
+        :param clock: time source in seconds
+        """
+        self.window = window
+        self.clock = clock
+        # (original ID, time) of the last ELECTION sent
+        self.election = None
+        # (message type, original ID, neighbour ID) -> time of the last LEADER_DOWN / NODE_DOWN sent
+        self.sent = {}
+        self.suppressed = Counter()
+        self.lock = threading.Lock()
+
+    def admit(self, message):
+        """
+        :return: False if the message is a duplicate and should not be sent
+        """
+        with self.lock:
+            return self.__admit(message)
+
+    def __admit(self, message):
+        now = self.clock()
+        if message.message_type == MessageType.ELECTION_ROUND:
+            if self.election is not None and now - self.election[1] < self.window and \
+                    message.original_id <= self.election[0]:
+                return self.__suppress(message)
+            self.election = (message.original_id, now)
+
+        elif message.message_type in (MessageType.LEADER_DOWN, MessageType.NODE_DOWN):
+            key = (message.message_type, message.original_id, getattr(message, 'neighbour_id', None))
+            if now - self.sent.get(key, -math.inf) < self.window:
+                return self.__suppress(message)
+            self.sent[key] = now
+            if len(self.sent) > 64:
+                self.sent = {key: when for key, when in self.sent.items() if now - when < self.window}
+
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'suppressed': sum(self.suppressed.values()), 'suppressed_by_type': dict(self.suppressed)}
+
+    def __suppress(self, message):
+        self.suppressed[message.message_type.name] += 1
+        return False
+
+
+class SeenCache:
+    """
+    (origin ID, sequence) of the messages handled lately, to drop a message coming again - a retried delivery, or a
+    message circulating around the ring after its origin went down. Holds at most capacity entries, the least recently
+    seen one goes first, and forgets an entry after ttl seconds. Both are O(1) per message
+    """
+    def __init__(self, capacity=SEEN_CACHE_SIZE, ttl=SEEN_TTL_SEC, clock=time.monotonic):
+        """
+        :param clock: time source in seconds
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (origin ID, sequence) -> time last seen, the least recently seen first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def seen(self, message):
+        """
+        Remembers the message
+        :return: True if it was seen within the ttl before
+        """
+        if message.sequence is None:
+            return False
+        key = (message.original_id, message.sequence)
+        now = self.clock()
+        with self.lock:
+            # the entries are in the order they were last seen, so the expired ones are at the front
+            while self.entries:
+                oldest_key, oldest = next(iter(self.entries.items()))
+                if now - oldest < self.ttl:
+                    break
+                del self.entries[oldest_key]
+                self.expirations += 1
+
+            hit = key in self.entries
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            if hit:
+                self.hits += 1
+                return True
+            self.misses += 1
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            looked_up = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / looked_up if looked_up else 0.0, 'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+def mean_std(values):
+    mean = sum(values) / len(values)
+    return mean, math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+
+
+class RingLogger:
+    """
+    Buffered logger - log() only appends the record to a buffer, a background thread formats the records and writes
+    them out in batches, so the request path never waits on the output. The records below the level are dropped right
+    away and the DEBUG ones can be sampled, which keeps the hot paths (pings) almost free unless debugging. All the
+    loggers of the process share one writer thread, see LogWriter
+    """
+    def __init__(self, node_id, path=None, level=INFO, sample_rate=1.0, json_lines=False, max_pending=10000,
+                 writer=None):
+        """
+        :param path: file to append to, stdout if None
+        :param level: lowest level written
+        :param sample_rate: fraction of the DEBUG records written
+        :param json_lines: write a JSON object per record instead of the text line
+        :param max_pending: records waiting to be written at most, more are dropped
+        :param writer: LogWriter writing the records out, the one of the process if None
+        """
+        self.node_id = node_id
+        self.path = path
+        self.level = level
+        self.sample_rate = sample_rate
+        self.json_lines = json_lines
+        self.max_pending = max_pending
+        self.writer = writer or LOG_WRITER
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.started = False
+        self.file = None
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, text, level=INFO, **fields):
+        """
+        :param fields: structured fields of the record, e.g. message_type, original_id, latency_ms
+        """
+        if level < self.level:
+            return
+        if level == DEBUG and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append((time.time(), level, text, fields))
+        if not self.started:
+            self.__start()
+
+    def flush(self):
+        """
+        Writes out everything logged so far
+        """
+        with self.lock:
+            records = []
+            while self.pending:
+                records.append(self.__format(*self.pending.popleft()))
+            if not records:
+                return
+            output = self.__output()
+            output.write(''.join(records))
+            output.flush()
+            self.written += len(records)
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'sampled_out': self.sampled_out,
+                'pending': len(self.pending)}
+
+    def __start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.writer.add(self)
+
+    def __output(self):
+        if self.path is None:
+            return sys.stdout
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        return self.file
+
+    def __format(self, timestamp, level, text, fields):
+        when = datetime.utcfromtimestamp(timestamp)
+        if self.json_lines:
+            record = {'time': when.isoformat(), 'level': LOG_LEVEL_NAMES.get(level, level), 'node_id': self.node_id,
+                      'text': text}
+            record.update(fields)
+            return json.dumps(record, default=str) + '\n'
+        extra = ''.join(f' {name}={value}' for name, value in fields.items())
+        return f'[{when}][{self.node_id}]\t{text}{extra}\n'
+
+
+class LogWriter:
+    """
+    Background thread writing out the records of all the loggers added to it - one per process, so that a process
+    hosting many nodes (async_app.py --local_nodes) does not run a thread per node
+    """
+    def __init__(self, flush_interval=0.2):
+        """
+        :param flush_interval: seconds between the writes
+        """
+        self.flush_interval = flush_interval
+        self.loggers = []
+        self.lock = threading.Lock()
+        self.started = False
+
+    def add(self, logger):
+        """
+        Starts writing out the logger's records, starts the thread with the first logger
+        """
+        with self.lock:
+            self.loggers.append(logger)
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.__run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def flush(self):
+        with self.lock:
+            loggers = list(self.loggers)
+        for logger in loggers:
+            try:
+                logger.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def __run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+LOG_WRITER = LogWriter()
+
+
+class Metrics:
+    """
+    Counters and latency histograms of a node, rendered in the Prometheus text format. The runtime records the
+    handled and sent messages, the protocol records the ring events - how long the election took and, on the leader,
+    how long it took from learning of a dead node until the ring was colored again
+    """
+    def __init__(self, clock=time.monotonic, buckets=LATENCY_BUCKETS_SEC):
+        """
+        :param clock: time source in seconds
+        :param buckets: upper bounds of the histogram buckets in seconds
+        """
+        self.clock = clock
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, label value) -> count
+        self.counters = Counter()
+        # (name, label value) -> [count per bucket, sum, count]
+        self.histograms = {}
+        # when the election / the recovery from a dead neighbour started, None if there is none going on
+        self.election_started_at = None
+        self.failure_detected_at = None
+
+    # ----------------------------------------------------------------------------------------------
+    # Runtime
+    # ----------------------------------------------------------------------------------------------
+
+    def message_handled(self, message, seconds):
+        """
+        A BATCH is counted and timed as a whole, and each message in it is counted under its own type
+        """
+        name = message.message_type.name
+        self.inc('ring_messages_received_total', name)
+        self.observe('ring_message_handle_seconds', seconds, name)
+        for inner in batched(message):
+            self.inc('ring_messages_received_total', inner.message_type.name)
+
+    def message_sent(self, message, seconds):
+        """
+        The same as message_handled, for the messages sent
+        """
+        name = message.message_type.name
+        self.inc('ring_messages_sent_total', name)
+        self.observe('ring_send_seconds', seconds, name)
+        for inner in batched(message):
+            self.inc('ring_messages_sent_total', inner.message_type.name)
+
+    def send_failed(self, message_type):
+        self.inc('ring_send_failures_total', message_type)
+
+    # ----------------------------------------------------------------------------------------------
+    # Protocol
+    # ----------------------------------------------------------------------------------------------
+
+    def election_started(self):
+        if self.election_started_at is None:
+            self.election_started_at = self.clock()
+
+    def leader_elected(self):
+        if self.election_started_at is not None:
+            self.observe('ring_election_seconds', self.clock() - self.election_started_at)
+            self.election_started_at = None
+
+    def failure_detected(self):
+        """
+        Only called on the leader - the other nodes are not told when the leader decides that no colors changed
+        """
+        # a failure coming while the ring is still being recolored is part of the same recovery
+        if self.failure_detected_at is None:
+            self.failure_detected_at = self.clock()
+
+    def ring_colored(self):
+        if self.failure_detected_at is not None:
+            self.observe('ring_recovery_seconds', self.clock() - self.failure_detected_at)
+            self.failure_detected_at = None
+
+    # ----------------------------------------------------------------------------------------------
+    # Storage and export
+    # ----------------------------------------------------------------------------------------------
+
+    def inc(self, name, label=None, value=1):
+        with self.lock:
+            self.counters[(name, label)] += value
+
+    def observe(self, name, value, label=None):
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self, gauges=None, counters=None):
+        """
+        :param gauges: dict name -> (help, value) of the current values the runtime knows about
+        :param counters: dict name -> (help, value) of the totals counted outside of Metrics, the value can be a dict
+        message type -> total
+        :return: text of the /metrics page
+        """
+        lines = []
+        for name, (text, value) in (gauges or {}).items():
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} gauge', f'{name} {value}']
+        for name, (text, value) in (counters or {}).items():
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} counter']
+            if isinstance(value, dict):
+                lines += [f'{name}{labels(label)} {total}' for label, total in sorted(value.items())]
+            else:
+                lines.append(f'{name} {value}')
+
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            histograms = sorted(self.histograms.items(), key=lambda item: (item[0][0], str(item[0][1])))
 
-    def next_neighbour_shift(self):
-        if self.mode == 'ip':
-            split_ip = self.right_neighbour_ip.split('.')
-            neighbour = int(split_ip[3])
+            for name, group in itertools.groupby(counters, key=lambda item: item[0][0]):
+                lines += [f'# HELP {name} {METRIC_HELP[name]}', f'# TYPE {name} counter']
+                lines += [f'{name}{labels(label)} {value}' for (_, label), value in group]
 
-            if self.node_count == 2:
-                # With two nodes we can't really shift anymore
-                return False
+            for name, group in itertools.groupby(histograms, key=lambda item: item[0][0]):
+                lines += [f'# HELP {name} {METRIC_HELP[name]}', f'# TYPE {name} histogram']
+                for (_, label), (counts, total, count) in group:
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{labels(label, bound)} {cumulative}')
+                    lines.append(f'{name}_bucket{labels(label, "+Inf")} {count}')
+                    lines.append(f'{name}_sum{labels(label)} {total}')
+                    lines.append(f'{name}_count{labels(label)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# help line of each metric recorded by Metrics
+METRIC_HELP = {
+    'ring_messages_received_total': 'Messages handled, by message type - a BATCH and each message in it',
+    'ring_message_handle_seconds': 'Time spent handling a received message, by message type',
+    'ring_messages_sent_total': 'Messages sent and replied to, by message type - a BATCH and each message in it',
+    'ring_send_seconds': 'Time from sending a message until the reply, by message type',
+    'ring_send_failures_total': 'Messages which could not be sent, by message type',
+    'ring_election_seconds': 'Time from starting an election until the leader was known',
+    'ring_recovery_seconds': 'Time from the leader learning of a dead node until the ring was colored again'
+}
+
+
+def seen_cache_metrics(seen, gauges):
+    """
+    Adds the gauges of the SeenCache to the gauges
+    :return: dict name -> (help, value) of its counters
+    """
+    stats = seen.stats()
+    gauges['ring_seen_cache_entries'] = ('Messages remembered to drop them when they come again', stats['size'])
+    gauges['ring_seen_cache_hit_rate'] = ('Fraction of the received messages which were seen before',
+                                          stats['hit_rate'])
+    return {
+        'ring_seen_cache_hits_total': ('Messages dropped as seen before', stats['hits']),
+        'ring_seen_cache_evictions_total': ('Remembered messages forgotten to make room', stats['evictions']),
+        'ring_seen_cache_expirations_total': ('Remembered messages forgotten after the TTL', stats['expirations'])
+    }
+
+
+def failure_detector_metrics(detector, gauges):
+    """
+    Adds the gauges of the FailureDetector to the gauges
+    :return: dict name -> (help, value) of its counters
+    """
+    stats = detector.stats()
+    gauges['ring_ping_timeout_seconds'] = ('Current timeout of the ping to the right neighbour', stats['timeout'])
+    gauges['ring_failure_false_positive_rate'] = ('Fraction of the suspicions which turned out to be alive',
+                                                  stats['false_positive_rate'])
+    gauges['ring_failure_detection_seconds'] = ('Average time from the last ping reply until the neighbour was '
+                                                'declared dead', stats['detection_latency_avg'])
+    return {
+        'ring_failure_suspicions_total': ('Times the right neighbour was suspected', stats['suspicions']),
+        'ring_failure_false_suspicions_total': ('Suspected neighbours which turned out to be alive',
+                                                stats['false_suspicions']),
+        'ring_failure_detections_total': ('Neighbours declared dead', stats['detections'])
+    }
+
+
+def timer_metrics(timer_manager, gauges):
+    """
+    Adds the gauges of the TimerManager or LoopTimerManager to the gauges
+    :return: dict name -> (help, value) of its counters
+    """
+    stats = timer_manager.stats()
+    gauges['ring_timers_pending'] = ('Timers waiting to fire', stats['pending'])
+    gauges['ring_timer_drift_seconds_avg'] = ('Average time by which the timers fired late', stats['drift_avg'])
+    gauges['ring_timer_drift_seconds_max'] = ('Longest time by which a timer fired late', stats['drift_max'])
+    # the callbacks of the LoopTimerManager run right when the timer fires
+    if 'latency_avg' in stats:
+        gauges['ring_timer_callback_latency_seconds_avg'] = ('Average time from the due time until the timer '
+                                                             'callback started', stats['latency_avg'])
+        gauges['ring_timer_callback_latency_seconds_max'] = ('Longest time from the due time until a timer '
+                                                             'callback started', stats['latency_max'])
+    return {'ring_timers_fired_total': ('Timers fired', stats['fired'])}
+
+
+def coalescer_metrics(coalescer):
+    """
+    :return: dict name -> (help, value) of the counters of the Coalescer
+    """
+    return {
+        'ring_suppressed_total': ('Duplicate control messages dropped before sending, by message type',
+                                  coalescer.stats()['suppressed_by_type'])
+    }
+
+
+def batched(message):
+    """
+    :return: messages in the BATCH, empty for the other messages
+    """
+    return message.messages if message.message_type == MessageType.BATCH else ()
+
+
+def labels(message_type=None, bucket=None):
+    """
+    :return: label set of a sample, e.g. {type="PING",le="0.5"}
+    """
+    pairs = []
+    if message_type is not None:
+        pairs.append(f'type="{message_type}"')
+    if bucket is not None:
+        pairs.append(f'le="{bucket}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Tracer:
+    """
+    Opt-in tracing of the round trips - a sampled message started by this node carries a [node ID, receive time,
+    send time] record of every hop, so when it comes back we can tell which hop was slow. The times are of the wall
+    clock of each node
+    """
+    def __init__(self, sample_rate=0.0, clock=time.time):
+        """
+        :param sample_rate: fraction of the round trips traced, 0 turns tracing off
+        :param clock: time source in seconds
+        """
+        self.sample_rate = sample_rate
+        self.clock = clock
+
+    def start(self, node_id, message):
+        """
+        Starts the trace of a message we are sending, if it is sampled
+        :return: the message
+        """
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            now = self.clock()
+            message.trace = [[node_id, now, now]]
+        return message
+
+    def received(self, node_id, message):
+        if message.trace is not None:
+            message.trace.append([node_id, self.clock(), None])
+
+    def forwarded(self, message):
+        if message.trace:
+            message.trace[-1][2] = self.clock()
+
+    @staticmethod
+    def profile(message):
+        """
+        :return: text of the per hop latencies of a trace which came back to its origin
+        """
+        trace = message.trace
+        lines = [f'Trace of {message.message_type.name}: {len(trace) - 1} hops, '
+                 f'{(trace[-1][1] - trace[0][2]) * 1000:.3f} ms in total',
+                 'Hop\tNode ID\tTransfer ms\tHandling ms']
+        slowest = None
+        for hop in range(1, len(trace)):
+            node_id, received, sent = trace[hop]
+            # from the previous node handing the message over until this node received it, including the queueing
+            transfer = (received - trace[hop - 1][2]) * 1000
+            handling = f'{(sent - received) * 1000:.3f}' if sent is not None else '-'
+            lines.append(f'{hop}\t{node_id}\t{transfer:.3f}\t{handling}')
+            if slowest is None or transfer > slowest[1]:
+                slowest = (hop, transfer)
+        if slowest is not None:
+            lines.append(f'Slowest hop {slowest[0]}, {slowest[1]:.3f} ms')
+        return '\n'.join(lines)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP sessions, one per target address, so that consecutive messages to the same node
+    reuse the TCP connection instead of opening a new one each time
+    """
+    def __init__(self, max_connections=4):
+        self.sessions = {}
+        # connections kept open per target, more are opened (and thrown away) under heavier concurrency
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        # counters of the sessions which were already closed
+        self.closed_hits = 0
+        self.closed_misses = 0
+
+    def post(self, address, data, **kwargs):
+        return self.__get_session(address).post(address, data, **kwargs)
+
+    def close(self, address):
+        """
+        Closes the session to the address, should be called when the node stops being our neighbour
+        :param address: target address
+        """
+        with self.lock:
+            session = self.sessions.pop(address, None)
+            if session is None:
+                return
+            hits, misses = self.__session_stats(session)
+            self.closed_hits += hits
+            self.closed_misses += misses
+        session.close()
+
+    def stats(self):
+        """
+        :return: dict with pool hits (requests sent over an already open connection) and misses (new connections)
+        """
+        with self.lock:
+            hits, misses = self.closed_hits, self.closed_misses
+            for session in self.sessions.values():
+                session_hits, session_misses = self.__session_stats(session)
+                hits += session_hits
+                misses += session_misses
+        return {'hits': hits, 'misses': misses}
+
+    def __get_session(self, address):
+        # imported here so that importing utils stays cheap for the runtimes which do not use requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self.lock:
+            session = self.sessions.get(address)
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections))
+                self.sessions[address] = session
+            return session
+
+    @staticmethod
+    def __session_stats(session):
+        hits, misses = 0, 0
+        pools = session.get_adapter('http://').poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            misses += pool.num_connections
+            hits += pool.num_requests - pool.num_connections
+        return hits, misses
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of outgoing messages served by a fixed set of worker threads instead of a new thread per message.
+    With a single worker (the default) the messages reach the neighbour in the order they were submitted. The messages
+    which piled up for the same target while a send was in progress go out together in one batch
+    """
+    def __init__(self, send, max_size=256, workers=1, retries=2, backoff=0.05, submit_timeout=1.0, on_failure=None,
+                 batch=None, max_batch=MAX_BATCH_SIZE):
+        """
+        :param send: function (message, this_address) doing the blocking send
+        :param max_size: queue capacity, submitting to a full queue blocks for up to submit_timeout
+        :param workers: number of sending threads, more than one gives up the ordering
+        :param retries: how many times a failed send is repeated
+        :param backoff: base delay before a retry, doubled each attempt and jittered
+        :param on_failure: function (message, exception) called when a message could not be sent at all
+        :param batch: function (messages, this_address) combining the messages into one, or returning None if the
+        target does not accept batches - no batching if not set
+        :param max_batch: most messages combined into one
+        """
+        self.send = send
+        self.batch = batch
+        self.max_batch = max_batch
+        self.queue = queue.Queue(max_size)
+        self.retries = retries
+        self.backoff = backoff
+        self.submit_timeout = submit_timeout
+        self.on_failure = on_failure
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.workers = workers
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.__work, daemon=True).start()
+
+    def submit(self, message, this_address=False):
+        """
+        Queues the message, blocking while the queue is full
+        :return: False if the queue stayed full and the message was rejected
+        """
+        try:
+            self.queue.put((message, this_address), timeout=self.submit_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+
+        with self.lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'batches': self.batches,
+                'batched': self.batched,
+                'latency_avg': self.latency_total / self.sent if self.sent else 0.0,
+                'latency_max': self.latency_max
+            }
+
+    def __work(self):
+        pending = None
+        while True:
+            message, this_address = pending if pending is not None else self.queue.get()
+            pending = None
+
+            # take whatever else is waiting for the same target
+            messages = [message]
+            while self.batch is not None and len(messages) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[1] != this_address:
+                    pending = item
+                    break
+                messages.append(item[0])
+
+            combined = self.batch(messages, this_address) if len(messages) > 1 else None
+            if combined is not None:
+                with self.lock:
+                    self.batches += 1
+                    self.batched += len(messages)
+                self.__send_with_retry(combined, this_address)
             else:
-                _next = neighbour + 1 if neighbour - IP_OFFSET != self.node_count else IP_OFFSET + 1
+                for message in messages:
+                    self.__send_with_retry(message, this_address)
+            for _ in messages:
+                self.queue.task_done()
+
+    def __send_with_retry(self, message, this_address):
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                self.send(message, this_address)
+            except Exception as e:
+                if attempt == self.retries:
+                    with self.lock:
+                        self.failed += 1
+                    if self.on_failure is not None:
+                        self.on_failure(message, e)
+                    return
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+                continue
 
-            self.right_neighbour_ip = f'{self.ip_prefix}.{_next}'
-            return self.right_neighbour_ip != self.ip
-        elif self.mode == 'port':
-            self.right_neighbour_port = self.right_neighbour_port + 1 if self.right_neighbour_port - 5000 != self.node_count else 5000 + 1
-            return self.right_neighbour_port != self.port
+            latency = time.monotonic() - start
+            with self.lock:
+                self.sent += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            return
 
 
 class TimerManager:
-    def __init__(self, timeout):
+    """
+    Named timers scheduled by a single thread on a heap, instead of a new thread for every timer. The callbacks run on
+    a fixed pool of worker threads, so a callback waiting on the network does not hold the other timers back.
+    Cancelling only marks the timer, the scheduler skips it when it comes up
+    """
+    def __init__(self, timeout, workers=4, clock=time.monotonic):
+        """
+        :param timeout: default seconds until a timer fires
+        :param workers: number of threads running the callbacks
+        :param clock: time source in seconds
+        """
         self.timers = {}
         self.timeout = timeout
+        self.workers = workers
+        self.clock = clock
         self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        # (due time, sequence, timer)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.cancelled = 0
+        self.callbacks = queue.Queue()
+        self.started = False
+
+        self.fired = 0
+        self.drift_total = 0.0
+        self.drift_max = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
 
-    def add_timer_and_run(self, key, func, purge=False):
+    def add_timer_and_run(self, key, func, purge=False, timeout=None):
         """
         Adds a timer and runs it
         :param key: timer key
         :param func: timer function
-        :param purge: by default if a timer with the key exists and does not have Timer.finished set
-        it is not overwritten and a new timer is not started. Setting purge to True overrides this behaviour
+        :param purge: by default if a timer with the key is pending or running it is not overwritten and a new timer
+        is not started. Setting purge to True overrides this behaviour
+        :param timeout: seconds until the timer fires, the manager's timeout if None
         :return:
         """
-        self.lock.acquire()
-        if key in self.timers.keys():
-            if not self.timers[key].finished.is_set() and not purge:
-                self.lock.release()
+        timeout = timeout if timeout is not None else self.timeout
+        with self.condition:
+            timer = self.timers.get(key)
+            if timer is not None and timer.alive() and not purge:
                 return
-            else:
-                self.timers[key] = threading.Timer(self.timeout, func)
-                self.timers[key].start()
-        else:
-            self.timers[key] = threading.Timer(self.timeout, func)
-            self.timers[key].start()
-        self.lock.release()
+            if timer is not None:
+                self.__cancel(timer)
+
+            timer = Timer(func, self.clock() + timeout)
+            self.timers[key] = timer
+            heapq.heappush(self.heap, (timer.due, next(self.sequence), timer))
+            self.__start()
+            self.condition.notify()
+
+    def cancel_timer(self, key):
+        with self.condition:
+            timer = self.timers.get(key)
+            if timer is not None:
+                self.__cancel(timer)
+
+    def check_timer_exists(self, key):
+        """
+        :return: True if the timer is pending or its function is running
+        """
+        with self.condition:
+            timer = self.timers.get(key)
+            return timer is not None and timer.alive()
+
+    def add_run_if_not_existing(self, key, func, timeout=None):
+        with self.condition:
+            exists = self.check_timer_exists(key)
+            if not exists:
+                self.add_timer_and_run(key, func, timeout=timeout)
+            return exists
+
+    def stats(self):
+        """
+        :return: dict with the number of pending timers, fired timers, drift (how late the scheduler fired them) and
+        callback latency (how late the callbacks started, including waiting for a free worker) in seconds
+        """
+        with self.condition:
+            return {
+                'pending': len(self.heap) - self.cancelled,
+                'fired': self.fired,
+                'drift_avg': self.drift_total / self.fired if self.fired else 0.0,
+                'drift_max': self.drift_max,
+                'latency_avg': self.latency_total / self.fired if self.fired else 0.0,
+                'latency_max': self.latency_max
+            }
+
+    def __start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self.__schedule, daemon=True).start()
+        for _ in range(self.workers):
+            threading.Thread(target=self.__work, daemon=True).start()
+
+    def __cancel(self, timer):
+        # the job cancelling its own timer - the key is free for a new timer right away, as with threading.Timer
+        if timer.state == Timer.RUNNING:
+            timer.state = Timer.CANCELLED
+            return
+        if timer.state != Timer.PENDING:
+            return
+        timer.state = Timer.CANCELLED
+        self.cancelled += 1
+        # do not let the heap fill up with cancelled timers
+        if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[2].state == Timer.PENDING]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def __schedule(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                due, _, timer = self.heap[0]
+                if timer.state == Timer.CANCELLED:
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+                    continue
+                delay = due - self.clock()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                timer.state = Timer.RUNNING
+                drift = self.clock() - due
+                self.fired += 1
+                self.drift_total += drift
+                self.drift_max = max(self.drift_max, drift)
+                self.callbacks.put(timer)
+
+    def __work(self):
+        while True:
+            timer = self.callbacks.get()
+            latency = self.clock() - timer.due
+            with self.condition:
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            try:
+                timer.func()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    timer.state = Timer.FINISHED
+
+
+class Timer:
+    PENDING = 0
+    RUNNING = 1
+    FINISHED = 2
+    CANCELLED = 3
+
+    __slots__ = ['func', 'due', 'state']
+
+    def __init__(self, func, due):
+        self.func = func
+        self.due = due
+        self.state = Timer.PENDING
+
+    def alive(self):
+        return self.state in (Timer.PENDING, Timer.RUNNING)
+
+
+class LoopTimerManager:
+    """
+    TimerManager for an event loop - the timers are callbacks scheduled on the loop instead of threads.
+    Works with anything providing call_later() and time() (asyncio loop, the simulator's virtual clock), must only
+    be used from the loop thread
+    """
+    def __init__(self, timeout, loop):
+        self.timers = {}
+        self.timeout = timeout
+        self.loop = loop
+        self.fired = 0
+        self.drift_total = 0.0
+        self.drift_max = 0.0
+
+    def add_timer_and_run(self, key, func, purge=False, timeout=None):
+        """
+        Adds a timer and runs it
+        :param key: timer key
+        :param func: timer function
+        :param purge: by default if a timer with the key is pending or running it is not overwritten and a new timer
+        is not started. Setting purge to True overrides this behaviour
+        :param timeout: seconds until the timer fires, the manager's timeout if None
+        :return:
+        """
+        timer = self.timers.get(key)
+        if timer is not None and not timer['finished'] and not purge:
+            return
+        if timer is not None:
+            timer['handle'].cancel()
+
+        timeout = timeout if timeout is not None else self.timeout
+        timer = {'finished': False, 'due': self.loop.time() + timeout}
+        timer['handle'] = self.loop.call_later(timeout, self.__fire, timer, func)
+        self.timers[key] = timer
 
     def cancel_timer(self, key):
-        self.lock.acquire()
         if key in self.timers.keys():
-            self.timers[key].cancel()
-        self.lock.release()
+            self.timers[key]['handle'].cancel()
+            self.timers[key]['finished'] = True
 
     def check_timer_exists(self, key):
-        self.lock.acquire()
-        exists = key in self.timers.keys()
-        self.lock.release()
-        return exists
+        """
+        :return: True if the timer is pending or its function is running
+        """
+        return key in self.timers.keys() and not self.timers[key]['finished']
 
-    def add_run_if_not_existing(self, key, func):
-        self.lock.acquire()
+    def add_run_if_not_existing(self, key, func, timeout=None):
         exists = self.check_timer_exists(key)
         if not exists:
-            self.add_timer_and_run(key, func)
-        self.lock.release()
+            self.add_timer_and_run(key, func, timeout=timeout)
         return exists
 
+    def stats(self):
+        """
+        :return: dict with the number of pending timers, fired timers and drift (how late they fired) in seconds - the
+        callbacks run right when the timer fires
+        """
+        return {
+            'pending': sum(1 for timer in self.timers.values() if not timer['finished']),
+            'fired': self.fired,
+            'drift_avg': self.drift_total / self.fired if self.fired else 0.0,
+            'drift_max': self.drift_max
+        }
+
+    def __fire(self, timer, func):
+        drift = self.loop.time() - timer['due']
+        self.fired += 1
+        self.drift_total += drift
+        self.drift_max = max(self.drift_max, drift)
+        try:
+            func()
+        finally:
+            timer['finished'] = True
+
 
 class BaseRequest:
+    # [node ID, receive time, send time] of every hop if the message is traced, see Tracer
+    trace = None
+    # None if the message came from an older node
+    sequence = None
+
     def __init__(self, original_id, message_type=None):
         self.original_id = original_id
         self.sender_id = original_id
         self.message_type = message_type
+        # together with the original ID identifies the message, the resent message keeps it
+        self.sequence = next(MESSAGE_SEQUENCE)
+
+
+# sequence numbers of the messages created by this process, starting at random so that a node restarted with the same
+# ID does not repeat the numbers of its previous run
+MESSAGE_SEQUENCE = itertools.count(random.getrandbits(31))
 
 
 class CollectRequest(BaseRequest):
-    def __init__(self, original_id):
+    # (ip, port) of the nodes in the same order as the IDs, None if the message came from an older node
+    addresses = None
+
+    def __init__(self, original_id, address=None):
         super(CollectRequest, self).__init__(original_id, MessageType.COLLECT_IDS)
         self.ids = [original_id]
+        if address is not None:
+            self.addresses = [address]
+
+
+class NodeDownRequest(BaseRequest):
+    def __init__(self, original_id, neighbour_id=None):
+        super(NodeDownRequest, self).__init__(original_id, MessageType.NODE_DOWN)
+        # the new right neighbour of the sender - the nodes between the two in the ring are down
+        self.neighbour_id = neighbour_id
 
 
 class ColorRequest(BaseRequest):
-    def __init__(self, original_id, all_node_ids):
+    # only the nodes whose color changed are in node_ids, the others keep their color
+    delta = False
+    # (ip, port) of the nodes in the same order as node_ids, only sent with the full coloring
+    addresses = None
+
+    def __init__(self, original_id, all_node_ids, previous_node_ids=None, node_addresses=None, strategy=None):
+        """
+        :param all_node_ids: IDs in the ring order
+        :param previous_node_ids: IDs the ring was colored with before, if set only the changes are sent
+        :param node_addresses: dict node ID -> (ip, port), sent along with the full coloring if set
+        :param strategy: decides which nodes are GREEN, FractionColoring if None
+        """
         super(ColorRequest, self).__init__(original_id, MessageType.COLORING)
-        self.node_color_dict = {}
-        self.__determine_coloring(all_node_ids)
+        strategy = strategy or FractionColoring()
+        green = strategy.green_bits(all_node_ids)
+        self.node_ids = all_node_ids
+        if node_addresses is not None and previous_node_ids is None:
+            self.addresses = [node_addresses[node] for node in all_node_ids]
+        if previous_node_ids is not None:
+            # '0' or '1' for every ID, compared as strings instead of Colors
+            previous = dict(zip(previous_node_ids, bit_string(strategy.green_bits(previous_node_ids),
+                                                              len(previous_node_ids))))
+            changed = [(node, bit) for node, bit in zip(all_node_ids, bit_string(green, len(all_node_ids)))
+                       if previous.get(node) != bit]
+            self.node_ids = [node for node, _ in changed]
+            green = int(''.join(bit for _, bit in reversed(changed)) or '0', 2)
+            self.delta = True
+        # bit i set means the i-th ID is GREEN, the same bitmap as in the binary format
+        self.green = green.to_bytes((len(self.node_ids) + 7) // 8, 'little')
+
+    def color_of(self, node_id):
+        """
+        :return: Color of the node, None if its color is not in the message
+        """
+        try:
+            index = self.node_ids.index(node_id)
+        except ValueError:
+            return None
+        return Color.GREEN if self.green[index >> 3] & (1 << (index & 7)) else Color.RED
+
+    def colors(self):
+        """
+        :return: (ID, Color) of the nodes in the message
+        """
+        bits = bit_string(int.from_bytes(self.green, 'little'), len(self.node_ids))
+        return [(node, Color.GREEN if bit == '1' else Color.RED) for node, bit in zip(self.node_ids, bits)]
+
+
+class JoinRequest(BaseRequest):
+    # filled in by the node the joining node is spliced after - its ID, the leader, the ID the joining node had before
+    # its restart if it was still in the ring, and (ip, port) of the joining node's right neighbour and of the leader
+    predecessor_id = None
+    leader_id = None
+    replaced_id = None
+    successor = None
+    leader_address = None
+
+    def __init__(self, original_id, address):
+        super(JoinRequest, self).__init__(original_id, MessageType.JOIN)
+        # (ip, port) of the joining node, its place in the ring
+        self.address = address
+        # nodes the message went through looking for the place
+        self.hops = 0
+
+
+class BatchRequest(BaseRequest):
+    def __init__(self, original_id, messages):
+        super(BatchRequest, self).__init__(original_id, MessageType.BATCH)
+        # processed in this order, as if they came one by one
+        self.messages = messages
+
+
+class ElectionPhaseRequest(BaseRequest):
+    # kinds of the message - the ID of the active sender, the ID it received, the maximum ID found
+    FIRST = 0
+    SECOND = 1
+    ELECTED = 2
+
+    def __init__(self, original_id, election_round, kind, value):
+        super(ElectionPhaseRequest, self).__init__(original_id, MessageType.ELECTION_PHASE)
+        self.election_round = election_round
+        self.kind = kind
+        self.value = value
+
+
+class ProbeRequest(BaseRequest):
+    def __init__(self, original_id, target_id):
+        super(ProbeRequest, self).__init__(original_id, MessageType.PROBE)
+        # the node we want to know about
+        self.target_id = target_id
+
+
+def bit_string(bits, count):
+    """
+    :return: '0' or '1' for each of the count lowest bits, the lowest first
+    """
+    return format(bits, f'0{count}b')[::-1] if count else ''
+
+
+class FractionColoring:
+    """
+    The first ceil(N * fraction) IDs in the ring order are GREEN, the rest RED
+    """
+    def __init__(self, fraction=GREEN_COLOR_FRACTION):
+        self.fraction = fraction
+
+    def green_bits(self, node_ids):
+        """
+        :param node_ids: IDs in the ring order
+        :return: bitset as an int, bit i set means the i-th ID is GREEN
+        """
+        return (1 << math.ceil(len(node_ids) * self.fraction)) - 1
+
+
+class WeightedColoring:
+    """
+    The IDs in the ring order are GREEN until they have the fraction of the total capacity, the rest RED. With equal
+    capacities this is the same as FractionColoring
+    """
+    def __init__(self, weights=None, fraction=GREEN_COLOR_FRACTION, default_weight=1.0):
+        """
+        :param weights: dict node ID -> capacity, default_weight for the IDs not in it
+        """
+        self.weights = weights or {}
+        self.fraction = fraction
+        self.default_weight = default_weight
 
-    def __determine_coloring(self, all_node_ids):
-        node_count = len(all_node_ids)
-        green_node_count = math.ceil(node_count * GREEN_COLOR_FRACTION)
-        green_nodes = all_node_ids[:green_node_count]
-        red_nodes = all_node_ids[green_node_count:]
+    def green_bits(self, node_ids):
+        if not node_ids:
+            return 0
+        totals = list(itertools.accumulate(self.weights.get(node, self.default_weight) for node in node_ids))
+        # the shortest prefix reaching the share, at least one node
+        green_count = bisect.bisect_left(totals, totals[-1] * self.fraction) + 1
+        return (1 << min(green_count, len(node_ids))) - 1
 
-        for green_node in green_nodes:
-            self.node_color_dict[green_node] = Color.GREEN
-        for red_node in red_nodes:
-            self.node_color_dict[red_node] = Color.RED
+
+class StableColoring:
+    """
+    The ceil(N * fraction) IDs with the lowest hash are GREEN, the rest RED. The colors do not depend on where the ring
+    starts, so a new leader keeps them, and a node joining or leaving changes the color of at most one other node
+    """
+    # multiplier of the Fibonacci hashing, spreads the IDs evenly over 32 bits - it is odd, so two 32-bit IDs never
+    # get the same hash
+    HASH_MULTIPLIER = 0x9E3779B1
+
+    def __init__(self, fraction=GREEN_COLOR_FRACTION):
+        self.fraction = fraction
+
+    def green_bits(self, node_ids):
+        green_count = math.ceil(len(node_ids) * self.fraction)
+        hashes = [(node_id * self.HASH_MULTIPLIER) & 0xFFFFFFFF for node_id in node_ids]
+        bitmap = bytearray((len(node_ids) + 7) // 8)
+        for index in sorted(range(len(node_ids)), key=hashes.__getitem__)[:green_count]:
+            bitmap[index >> 3] |= 1 << (index & 7)
+        return int.from_bytes(bitmap, 'little')
+
+
+# coloring strategies by their configured name
+COLORING_STRATEGIES = {'fraction': FractionColoring, 'weighted': WeightedColoring, 'stable': StableColoring}
 
 
 class BaseResponse:
@@ -175,3 +1794,326 @@ class MessageType(Enum):
     NODE_DOWN = 'node_down',
     # If the node that went down is the leader and a new election has to start
     LEADER_DOWN = 'leader_down'
+    # Ask a node when it last heard from its left neighbour, before declaring the neighbour dead
+    PROBE = 'probe'
+    # Several messages for the right neighbour sent in one request
+    BATCH = 'batch'
+    # A (re)started node asks to be spliced into the running ring
+    JOIN = 'join'
+    # One step of the Peterson election
+    ELECTION_PHASE = 'election_phase'
+
+
+
+# --------------------------------------------------------------------------------------------------
+# Wire codecs
+# --------------------------------------------------------------------------------------------------
+
+# Small integer codes for the message types, used by the binary codec - never reuse a code
+MESSAGE_TYPE_CODES = {
+    MessageType.PING: 0,
+    MessageType.ELECTION_ROUND: 1,
+    MessageType.LEADER_ELECTED: 2,
+    MessageType.COLLECT_IDS: 3,
+    MessageType.COLORING: 4,
+    MessageType.NODE_DOWN: 5,
+    MessageType.LEADER_DOWN: 6,
+    MessageType.PROBE: 7,
+    MessageType.BATCH: 8,
+    MessageType.JOIN: 9,
+    MessageType.ELECTION_PHASE: 10
+}
+MESSAGE_TYPES_BY_CODE = {code: message_type for message_type, code in MESSAGE_TYPE_CODES.items()}
+
+
+class JsonPickleCodec:
+    """
+    The original wire format, kept as a fallback for nodes that do not support the binary one
+    """
+    name = 'jsonpickle'
+    content_type = 'application/json'
+
+    def encode(self, message, sequence=True):
+        import jsonpickle
+        return jsonpickle.encode(self.compatible(message), keys=True)
+
+    def decode(self, data):
+        import jsonpickle
+        message = jsonpickle.decode(data, keys=True)
+        # a COLORING from an older node only has node_color_dict
+        if isinstance(message, ColorRequest) and 'node_ids' not in vars(message):
+            message.node_ids = list(message.node_color_dict)
+            green = sum(1 << index for index, node in enumerate(message.node_ids)
+                        if message.node_color_dict[node] == Color.GREEN)
+            message.green = green.to_bytes((len(message.node_ids) + 7) // 8, 'little')
+        return message
+
+    @staticmethod
+    def compatible(message):
+        """
+        :return: the message in the shape the older nodes can read, the newer ones read it the same
+        """
+        # the older nodes do not have the class and would decode a dict, the neighbour ID is just an extra attribute
+        if isinstance(message, NodeDownRequest):
+            compatible = BaseRequest.__new__(BaseRequest)
+            compatible.__dict__.update(message.__dict__)
+            return compatible
+        # the older nodes read the colors from node_color_dict
+        if isinstance(message, ColorRequest):
+            compatible = copy.copy(message)
+            compatible.node_color_dict = dict(message.colors())
+            return compatible
+        return message
+
+
+class BinaryCodec:
+    """
+    Fixed-schema binary format
+
+    header: magic (B), schema version (B), message type code (B), original ID (I), sender ID (I)
+    sequence, if the second highest bit of the type code is set: sequence number (I) - right after the header, only
+    sent to the nodes advertising it
+    trace, if the high bit of the type code is set: hop count (H), for each hop node ID (I), receive and send time (d)
+    - after the sequence, only sent to the nodes advertising it, the send time is NaN if not sent yet
+    COLLECT_IDS body: ID count (I), IDs (I each), addresses (optional)
+    COLORING body: ID count (I), IDs (I each), color bitmap - bit i set means the i-th ID is GREEN, flags (B, optional)
+    - bit 0 set means a delta coloring, addresses (optional)
+    addresses: host count (H), for each host its length (B) and UTF-8 name, then for each ID host index (H), port (H)
+    NODE_DOWN body: new neighbour ID of the sender (I, optional)
+    PROBE body: target ID (I)
+    BATCH body: message count (H), for each message its length (I) and the message in this format
+    JOIN body: joining node address, hops (H), then once spliced (optional) predecessor ID (I), leader ID (I), replaced
+    ID (I, all ones if none), successor address and leader address - an address is host length (B), UTF-8 host and
+    port (H), port 0 if none
+    ELECTION_PHASE body: election round (I), kind (B), carried ID (I)
+
+    The optional fields are appended at the end, so the older decoders simply do not read them
+    """
+    name = 'binary'
+    content_type = 'application/x-ring-message'
+
+    MAGIC = 0xD5
+    VERSION = 1
+    HEADER = struct.Struct('>BBBII')
+    COUNT = struct.Struct('>I')
+    ID = struct.Struct('>I')
+    FLAGS = struct.Struct('>B')
+    FLAG_DELTA = 1
+    TYPE_TRACED = 0x80
+    TYPE_SEQUENCED = 0x40
+    SEQUENCE = struct.Struct('>I')
+    TRACE_COUNT = struct.Struct('>H')
+    TRACE_HOP = struct.Struct('>Idd')
+    HOST_LENGTH = struct.Struct('>B')
+    HOST_COUNT = struct.Struct('>H')
+    ADDRESS = struct.Struct('>HH')
+    BATCH_COUNT = struct.Struct('>H')
+    HOPS = struct.Struct('>H')
+    PORT = struct.Struct('>H')
+    SPLICE = struct.Struct('>III')
+    PHASE = struct.Struct('>IBI')
+    NO_ID = 0xFFFFFFFF
+    LENGTH = struct.Struct('>I')
+
+    def encode(self, message, sequence=True):
+        """
+        :param sequence: write the sequence number, False for the nodes which do not read it
+        """
+        type_code = MESSAGE_TYPE_CODES[message.message_type]
+        trace = getattr(message, 'trace', None)
+        sequence = getattr(message, 'sequence', None) if sequence else None
+        if trace is not None:
+            type_code |= self.TYPE_TRACED
+        if sequence is not None:
+            type_code |= self.TYPE_SEQUENCED
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, type_code, message.original_id, message.sender_id)
+        if sequence is not None:
+            header += self.SEQUENCE.pack(sequence & 0xFFFFFFFF)
+        if trace is not None:
+            header += self.TRACE_COUNT.pack(len(trace)) + b''.join(
+                self.TRACE_HOP.pack(node_id, received, sent if sent is not None else math.nan)
+                for node_id, received, sent in trace)
+
+        if message.message_type == MessageType.COLLECT_IDS:
+            return header + self.__pack_ids(message.ids) + self.__pack_addresses(message.addresses, message.ids)
+        elif message.message_type == MessageType.COLORING:
+            addresses = self.__pack_addresses(message.addresses, message.node_ids)
+            flags = self.FLAGS.pack(self.FLAG_DELTA if message.delta else 0) if message.delta or addresses else b''
+            return header + self.__pack_ids(message.node_ids) + message.green + flags + addresses
+        elif message.message_type == MessageType.NODE_DOWN:
+            neighbour_id = getattr(message, 'neighbour_id', None)
+            return header + self.ID.pack(neighbour_id) if neighbour_id is not None else header
+        elif message.message_type == MessageType.PROBE:
+            return header + self.ID.pack(message.target_id)
+        elif message.message_type == MessageType.BATCH:
+            packed = [header, self.BATCH_COUNT.pack(len(message.messages))]
+            for inner in message.messages:
+                data = self.encode(inner, sequence is not None)
+                packed.append(self.LENGTH.pack(len(data)) + data)
+            return b''.join(packed)
+        elif message.message_type == MessageType.JOIN:
+            packed = [header, self.__pack_address(message.address), self.HOPS.pack(message.hops)]
+            if message.predecessor_id is not None:
+                replaced_id = message.replaced_id if message.replaced_id is not None else self.NO_ID
+                packed += [self.SPLICE.pack(message.predecessor_id, message.leader_id, replaced_id),
+                           self.__pack_address(message.successor), self.__pack_address(message.leader_address)]
+            return b''.join(packed)
+        elif message.message_type == MessageType.ELECTION_PHASE:
+            return header + self.PHASE.pack(message.election_round, message.kind, message.value)
+
+        return header
+
+    def decode(self, data):
+        magic, version, type_code, original_id, sender_id = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError('Not a binary ring message')
+        if version != self.VERSION:
+            raise ValueError(f'Unsupported binary message version {version}')
+
+        message_type = MESSAGE_TYPES_BY_CODE[type_code & ~(self.TYPE_TRACED | self.TYPE_SEQUENCED)]
+        offset = self.HEADER.size
+        sequence, trace = None, None
+        if type_code & self.TYPE_SEQUENCED:
+            sequence, = self.SEQUENCE.unpack_from(data, offset)
+            offset += self.SEQUENCE.size
+        if type_code & self.TYPE_TRACED:
+            count, = self.TRACE_COUNT.unpack_from(data, offset)
+            offset += self.TRACE_COUNT.size
+            trace = [[node_id, received, sent if not math.isnan(sent) else None]
+                     for node_id, received, sent in self.TRACE_HOP.iter_unpack(
+                         data[offset:offset + count * self.TRACE_HOP.size])]
+            offset += count * self.TRACE_HOP.size
+
+        if message_type == MessageType.COLLECT_IDS:
+            message = CollectRequest(original_id)
+            message.ids, offset = self.__unpack_ids(data, offset)
+            if len(data) > offset:
+                message.addresses = self.__unpack_addresses(data, offset, len(message.ids))
+        elif message_type == MessageType.COLORING:
+            message = ColorRequest(original_id, [])
+            ids, offset = self.__unpack_ids(data, offset)
+            message.node_ids = ids
+            message.green = bytes(data[offset:offset + (len(ids) + 7) // 8])
+            offset += len(message.green)
+            if len(data) > offset:
+                message.delta = bool(self.FLAGS.unpack_from(data, offset)[0] & self.FLAG_DELTA)
+                offset += self.FLAGS.size
+            if len(data) > offset:
+                message.addresses = self.__unpack_addresses(data, offset, len(ids))
+        elif message_type == MessageType.NODE_DOWN:
+            message = NodeDownRequest(original_id)
+            if len(data) > offset:
+                message.neighbour_id, = self.ID.unpack_from(data, offset)
+        elif message_type == MessageType.PROBE:
+            message = ProbeRequest(original_id, self.ID.unpack_from(data, offset)[0])
+        elif message_type == MessageType.BATCH:
+            message = BatchRequest(original_id, [])
+            count, = self.BATCH_COUNT.unpack_from(data, offset)
+            offset += self.BATCH_COUNT.size
+            for _ in range(count):
+                length, = self.LENGTH.unpack_from(data, offset)
+                offset += self.LENGTH.size
+                message.messages.append(self.decode(data[offset:offset + length]))
+                offset += length
+        elif message_type == MessageType.JOIN:
+            address, offset = self.__unpack_address(data, offset)
+            message = JoinRequest(original_id, address)
+            message.hops, = self.HOPS.unpack_from(data, offset)
+            offset += self.HOPS.size
+            if len(data) > offset:
+                message.predecessor_id, message.leader_id, replaced_id = self.SPLICE.unpack_from(data, offset)
+                message.replaced_id = replaced_id if replaced_id != self.NO_ID else None
+                message.successor, offset = self.__unpack_address(data, offset + self.SPLICE.size)
+                message.leader_address, offset = self.__unpack_address(data, offset)
+        elif message_type == MessageType.ELECTION_PHASE:
+            message = ElectionPhaseRequest(original_id, *self.PHASE.unpack_from(data, offset))
+        else:
+            message = BaseRequest(original_id, message_type)
+
+        message.sender_id = sender_id
+        message.sequence = sequence
+        if trace is not None:
+            message.trace = trace
+        return message
+
+    def __pack_ids(self, ids):
+        return self.COUNT.pack(len(ids)) + struct.pack(f'>{len(ids)}I', *ids)
+
+    def __unpack_ids(self, data, offset):
+        count, = self.COUNT.unpack_from(data, offset)
+        offset += self.COUNT.size
+        ids = list(struct.unpack_from(f'>{count}I', data, offset))
+        return ids, offset + 4 * count
+
+    def __pack_address(self, address):
+        host, port = address if address is not None else ('', 0)
+        host = host.encode('utf-8')
+        return self.HOST_LENGTH.pack(len(host)) + host + self.PORT.pack(port)
+
+    def __unpack_address(self, data, offset):
+        length, = self.HOST_LENGTH.unpack_from(data, offset)
+        offset += self.HOST_LENGTH.size
+        host = bytes(data[offset:offset + length]).decode('utf-8')
+        port, = self.PORT.unpack_from(data, offset + length)
+        return (host, port) if port else None, offset + length + self.PORT.size
+
+    def __pack_addresses(self, addresses, ids):
+        # the addresses are only sent if there is one for every ID
+        if addresses is None or len(addresses) != len(ids):
+            return b''
+        # the hosts repeat a lot (all nodes on localhost), each is sent once
+        hosts = {}
+        for host, _ in addresses:
+            hosts.setdefault(host, len(hosts))
+        packed = [self.HOST_COUNT.pack(len(hosts))]
+        for host in hosts:
+            host = host.encode('utf-8')
+            packed.append(self.HOST_LENGTH.pack(len(host)) + host)
+        packed.extend(self.ADDRESS.pack(hosts[host], port) for host, port in addresses)
+        return b''.join(packed)
+
+    def __unpack_addresses(self, data, offset, count):
+        host_count, = self.HOST_COUNT.unpack_from(data, offset)
+        offset += self.HOST_COUNT.size
+        hosts = []
+        for _ in range(host_count):
+            length, = self.HOST_LENGTH.unpack_from(data, offset)
+            offset += self.HOST_LENGTH.size
+            hosts.append(bytes(data[offset:offset + length]).decode('utf-8'))
+            offset += length
+        return [(hosts[host], port) for host, port in self.ADDRESS.iter_unpack(data[offset:offset + count * 4])]
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), JsonPickleCodec())}
+# in order of preference, advertised in replies so that the sender can pick the best one
+SUPPORTED_CODECS = [BinaryCodec.name, JsonPickleCodec.name]
+DEFAULT_CODEC = JsonPickleCodec.name
+
+
+def negotiate_codec(advertised):
+    """
+    Picks the preferred codec out of those the other node advertised. Nodes that do not advertise anything
+    only understand jsonpickle
+    :param advertised: list of codec names, possibly None
+    :return: codec name
+    """
+    for name in SUPPORTED_CODECS:
+        if advertised and name in advertised:
+            return name
+    return DEFAULT_CODEC
+
+
+def encode_message(message, codec_name=DEFAULT_CODEC, sequence=True):
+    """
+    :param sequence: send the sequence number, False for the nodes which do not read it
+    :return: (payload, content type)
+    """
+    codec = CODECS[codec_name]
+    return codec.encode(message, sequence), codec.content_type
+
+
+def decode_message(data, content_type=None):
+    # anything not explicitly binary is jsonpickle, which is what the older nodes send
+    if content_type == BinaryCodec.content_type:
+        return CODECS[BinaryCodec.name].decode(data)
+    return CODECS[JsonPickleCodec.name].decode(data)